@@ -0,0 +1,76 @@
+'''Reverted transactions detection benchmark on a synthetic mempool.
+
+Compares the old per-address loop with the vectorized detection used by
+BlockCollector. Run from the repository root:
+
+    python -m benchmarks.reverted_txs --n-txs 100000
+'''
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from censorability_monitor.data_collection.collector import \
+    find_reverted_transactions
+
+
+def make_mempool(n_txs: int, n_senders: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    senders = [f'0x{i:040x}' for i in range(n_senders)]
+    tx_df = pd.DataFrame({
+        'hash': [f'0x{i:064x}' for i in range(n_txs)],
+        'from': rng.choice(senders, n_txs),
+        'nonce': rng.integers(0, 100, n_txs)})
+    # Part of senders has no account data
+    address_data = {a: {'n_txs': int(rng.integers(0, 100)), 'eth': 1.0}
+                    for a in senders if rng.random() < 0.9}
+    return tx_df, address_data
+
+
+def find_reverted_transactions_loop(tx_df, address_data):
+    tx_grouped = tx_df.groupby(['from', 'hash']).agg({'nonce': 'first'})
+    reverted_tx_hashes = set()
+    for addr in tx_df['from'].unique():
+        if addr not in address_data:
+            continue
+        n_txs = address_data[addr]['n_txs']
+        addr_txs = tx_grouped.loc[addr].sort_values(
+            'nonce', ascending=True
+            ).reset_index()
+        addr_txs['reverted'] = addr_txs['nonce'] < n_txs
+        reverted_tx_hashes.update(addr_txs[addr_txs['reverted']]['hash'])
+    return reverted_tx_hashes
+
+
+def timeit(func, *args, repeat: int = 3):
+    best = float('inf')
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - t1)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-txs', type=int, default=100_000)
+    parser.add_argument('--n-senders', type=int, default=5000)
+    args = parser.parse_args()
+
+    tx_df, address_data = make_mempool(args.n_txs, args.n_senders)
+    expected, loop_time = timeit(find_reverted_transactions_loop,
+                                 tx_df, address_data, repeat=1)
+    result, vectorized_time = timeit(find_reverted_transactions,
+                                     tx_df, address_data)
+    assert result == expected, 'Results differ'
+
+    print(f'{args.n_txs} txs, {args.n_senders} senders, '
+          f'{len(result)} reverted')
+    print(f'loop:       {loop_time:.3f} s')
+    print(f'vectorized: {vectorized_time:.3f} s')
+    print(f'speedup:    {loop_time / vectorized_time:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,8 +17,23 @@ from censorability_monitor.analytics.fetch import (get_addresses_from_receipt,
                                                    load_mempool_state)
 from censorability_monitor.analytics.validators import (get_validator_info,
                                                         get_validator_pubkey)
+from censorability_monitor.data_collection.blocks import (BlockCache,
+                                                          get_block_hashes)
+from censorability_monitor.data_collection.checkpoints import (
+    CHECKPOINTS_COLLECTION, STAGE_ANALYTICS, STAGE_GAS_ESTIMATED,
+    CheckpointStore, prepare_checkpoints)
+from censorability_monitor.data_collection.connection import (
+    WEB3_CONNECTION_TYPES, get_web3_client)
+from censorability_monitor.data_collection.estimates import \
+    GasEstimateStore
+from censorability_monitor.data_collection.handoff import BlockEvents
 from censorability_monitor.data_collection.ofac import (
     get_banned_wallets, get_grouped_by_prefixes)
+from censorability_monitor.indexes import (ANALYTICS_INDEXES,
+                                           ANALYTICS_QUERIES, API_INDEXES,
+                                           API_QUERIES, COLLECTOR_INDEXES,
+                                           COLLECTOR_QUERIES,
+                                           check_query_plans, ensure_indexes)
 
 
 class CensorshipMonitor:
@@ -30,6 +45,7 @@ class CensorshipMonitor:
                  beacon_url: str,
                  model_path: str,
                  interval: float, verbose: bool, start_block: int = 0,
+                 checkpoint_history_size: int = 100_000,
                  name: str = 'CensorshipMonitor'):
         self.mongo_url = mongo_url
         self.mongo_analytics_url = mongo_analytics_url
@@ -43,6 +59,11 @@ class CensorshipMonitor:
         self.start_block = start_block
         self.beacon_url = beacon_url
         self.ofac_cache = None
+        self.blocks = BlockCache()
+        self.block_events = None
+        self.checkpoints = None
+        # Per-block history of the analytics stage, 0 - no history
+        self.checkpoint_history_size = checkpoint_history_size
         with open(model_path, 'rb') as f:
             self.model = pickle.load(f)
 
@@ -54,8 +75,8 @@ class CensorshipMonitor:
 
     def get_web3_client(self):
         logger = logging.getLogger(self.name)
-        if self.web3_type == 'ipc':
-            w3 = Web3(Web3.IPCProvider(self.web3_url))
+        if self.web3_type in WEB3_CONNECTION_TYPES:
+            w3 = get_web3_client(self.web3_type, self.web3_url)
             # logger.info(f'Connected to ETH node: {w3.isConnected()}')
             return w3
         else:
@@ -69,44 +90,37 @@ class CensorshipMonitor:
 
     def get_last_processed_block_number(self, db: Database) -> int:
         ''' Get number of last processed block (if restarted)'''
-        processed_blocks = db['processed_blocks']
-        last_processed_block_query = processed_blocks.find().sort(
-                'block_number', -1).limit(1)
-        try:
-            last_processed = next(last_processed_block_query)
-            return last_processed['block_number']
-        except StopIteration:
-            return 0
+        last_processed = CheckpointStore(db).get_last_block(STAGE_ANALYTICS)
+        return 0 if last_processed is None else last_processed
+
+    async def get_ready_checkpoint(self, db: Database) -> Dict[str, Any]:
+        ''' Gas estimation checkpoint, waits for the first ready block'''
+        checkpoints = CheckpointStore(db)
+        while True:
+            checkpoint = checkpoints.get_checkpoint(STAGE_GAS_ESTIMATED)
+            if checkpoint is not None:
+                return checkpoint
+            await self.block_events.wait(1)
 
     async def get_first_ready_block_number(self, db: Database) -> int:
         ''' Get number of the first block which is ready to analysis'''
-        data_collected_blocks = db['processed_blocks']
-        all_ready_blocks = data_collected_blocks.count_documents(
-                {'block_gas_estimated': {'$exists': True}})
-        # Wait for the first block to be ready for analysis
-        while all_ready_blocks == 0:
-            all_ready_blocks = data_collected_blocks.count_documents(
-                {'block_gas_estimated': {'$exists': True}})
-            await asyncio.sleep(1)
-        first_ready_block_query = data_collected_blocks.find(
-            {'block_gas_estimated': {'$exists': True}}
-        ).sort('block_gas_estimated', 1).limit(1)
-        return next(first_ready_block_query)['block_gas_estimated']
+        return (await self.get_ready_checkpoint(db))['first_block']
 
     async def get_last_ready_block_number(self, db: Database) -> int:
         ''' Get number of the last block which is ready to analysis'''
-        data_collected_blocks = db['processed_blocks']
-        all_ready_blocks = data_collected_blocks.count_documents(
-                {'block_gas_estimated': {'$exists': True}})
-        # Wait for the first block to be ready for analysis
-        while all_ready_blocks == 0:
-            all_ready_blocks = data_collected_blocks.count_documents(
-                {'block_gas_estimated': {'$exists': True}})
-            await asyncio.sleep(1)
-        last_ready_block_query = data_collected_blocks.find(
-            {'block_gas_estimated': {'$exists': True}}
-        ).sort('block_gas_estimated', -1).limit(1)
-        return next(last_ready_block_query)['block_gas_estimated']
+        return (await self.get_ready_checkpoint(db))['last_block']
+
+    def prepare_databases(self, db_collector: Database,
+                          db_analytics: Database):
+        ''' Create checkpoints and indexes and check hot queries plans,
+            API reads the analytics DB'''
+        ensure_indexes(db_collector, COLLECTOR_INDEXES)
+        check_query_plans(db_collector, COLLECTOR_QUERIES)
+        prepare_checkpoints(db_analytics, self.checkpoint_history_size,
+                            {STAGE_ANALYTICS: 'block_number'})
+        ensure_indexes(db_analytics, ANALYTICS_INDEXES)
+        ensure_indexes(db_analytics, API_INDEXES)
+        check_query_plans(db_analytics, ANALYTICS_QUERIES + API_QUERIES)
 
     async def run(self):
         logger = logging.getLogger(self.name)
@@ -114,6 +128,12 @@ class CensorshipMonitor:
         mongo_analytics_client = self.get_mongo_analytics_client()
         db_collector = mongo_client[self.collector_db_name]
         db_analytics = mongo_analytics_client[self.analytics_db_name]
+        self.prepare_databases(db_collector, db_analytics)
+        self.checkpoints = CheckpointStore(db_analytics)
+        # Woken up by MemPoolGasEstimator inserts with a change stream
+        # or polls every second
+        self.block_events = BlockEvents(db_collector[CHECKPOINTS_COLLECTION],
+                                        STAGE_GAS_ESTIMATED, name=self.name)
 
         logger.info('Select starting block')
         last_processed_block = self.get_last_processed_block_number(
@@ -136,7 +156,7 @@ class CensorshipMonitor:
         current_block = max(first_ready_block, last_processed_block) + 1
         while True:
             while current_block > last_ready_block:
-                await asyncio.sleep(1)
+                await self.block_events.wait(1)
                 last_ready_block = await self.get_last_ready_block_number(
                     db_collector)
             while current_block <= last_ready_block:
@@ -152,7 +172,7 @@ class CensorshipMonitor:
         # Update validators and ofac list
         mongo_client = self.get_mongo_analytics_client()
         db = mongo_client[self.analytics_db_name]
-        block = w3.eth.getBlock(block_number)
+        block = self.blocks.get_block(w3, block_number)
         block_ts = block['timestamp']
         try:
             self.update_ofac_list_and_validators(block_ts, db)
@@ -167,12 +187,8 @@ class CensorshipMonitor:
             logger.error(f'Error with block {block_number}: {type(e)} {e}')
             raise e
         # Save block_number to db
-        mongo_analytics_client = self.get_mongo_analytics_client()
-        db_analytics = mongo_analytics_client[self.analytics_db_name]
-        processed_blocks = db_analytics['processed_blocks']
-        processed_blocks.insert_one(
-            {'block_number': block_number,
-             'success': success})
+        self.checkpoints.advance(STAGE_ANALYTICS, block_number,
+                                 {'success': success})
 
     async def process_one_block(self, block: Dict, block_number: int):
         logger = logging.getLogger(self.name)
@@ -185,10 +201,10 @@ class CensorshipMonitor:
         # Get validator name
         validator_name = await self.get_validator_name(block_number, block_ts)
         # Transactions
-        block_txs = [b.hex() for b in block['transactions']]
+        block_txs = get_block_hashes(block)
         db = mongo_client[self.collector_db_name]
         try:
-            mempool_txs = load_mempool_state(db, block_number, w3)
+            mempool_txs = load_mempool_state(db, block_number, w3, block)
         except Exception as e:
             logger.error(f'Mempool error {block_number} {type(e)} {e}')
 
@@ -221,7 +237,8 @@ class CensorshipMonitor:
         # Достанем детали из блокчейна для "транзакций, напрямую попавших в
         # блок" и "транзакции, найденные в БД, но без деталей"
         txs_no_details = db_txs_without_details.union(not_found_in_db_txs)
-        additional_details = self.get_txs_details_from_w3(txs_no_details, w3)
+        additional_details = self.get_txs_details_from_w3(
+            txs_no_details, block, w3)
         # Соберем потребление газа для транзакций
         gas_consumption = self.gather_gas_estimation(
             txs_details=txs_details_from_db,
@@ -302,7 +319,6 @@ class CensorshipMonitor:
         suspicious_txs.reset_index(drop=True, inplace=True)
         # Save them to tx_censored
         censored_collection = db_analytics['censored_txs']
-        censored_collection.create_index('hash', unique=True)
         for _, row in suspicious_txs.iterrows():
             censored_collection.update_one(
                 {'hash': {'$eq': row['hash']}},
@@ -447,9 +463,15 @@ class CensorshipMonitor:
         return {r['hash']: r for r in tx_details_db}
 
     def get_txs_details_from_w3(self, hashes_list: Set[str],
+                                block: Dict[str, Any],
                                 w3: Web3) -> Dict[str, Any]:
+        ''' Txs details from the block, other txs are requested one by one'''
         additional_details = {}
+        block_txs = {tx['hash'].hex(): tx for tx in block['transactions']}
         for tx_hash in hashes_list:
+            if tx_hash in block_txs:
+                additional_details[tx_hash] = block_txs[tx_hash]
+                continue
             try:
                 transaction = w3.eth.get_transaction(tx_hash)
                 additional_details[tx_hash] = transaction
@@ -468,14 +490,9 @@ class CensorshipMonitor:
 
         txs_details_hashes = set(txs_details.keys())
         # Собираем для тех, для которых были детали в ДБ
-        estimated_gas_collection = db['tx_estimated_gas']
-        estimations_from_db = estimated_gas_collection.find(
-            {'hash': {'$in': list(txs_details_hashes)}})
-
-        for estimation in estimations_from_db:
-            prev_block = str(block_number - 1)
-            if prev_block in estimation:
-                gas_consumption[estimation['hash']] = estimation[prev_block]
+        estimates_store = GasEstimateStore(db['tx_estimated_gas'])
+        gas_consumption.update(estimates_store.load_estimates(
+            list(txs_details_hashes), block_number - 1))
 
         # Если estimation по газу не число - то заменяем на gas из details
         for tx_hash in gas_consumption:
@@ -557,7 +574,7 @@ class CensorshipMonitor:
         df['mempool'] = True
         df.loc[df['hash'].isin(not_in_mempool), 'mempool'] = False
 
-        prev_block = w3.eth.get_block(block_number - 1)
+        prev_block = self.blocks.get_block(w3, block_number - 1)
         df['prev_block_gasUsed'] = prev_block['gasUsed']
         df['prev_block_baseFeePerGas'] = prev_block['baseFeePerGas'] / 10 ** 9
         change = df['baseFeePerGas'] - df['prev_block_baseFeePerGas']
@@ -0,0 +1,158 @@
+import bisect
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+
+class AccountHistoryStore:
+    '''Accounts state history in addresses_info collection.
+       One document per address:
+       {
+           address: '0x...',
+           latest: {block: N, n_txs: ..., eth: ...},
+           history: [{block: ..., n_txs: ..., eth: ...}, ...]
+       }
+       latest is the snapshot with the highest block, history keeps
+       the last history_size snapshots sorted by block. Documents of
+       the old schema {address, '<block>': {n_txs, eth}} not migrated
+       yet are read as well'''
+    def __init__(self, collection: Collection, history_size: int = 128):
+        self.collection = collection
+        self.history_size = history_size
+
+    def save_operations(self, states: Dict[str, Dict[str, Any]],
+                        block_number: int) -> List[UpdateOne]:
+        '''
+        Write operations to save accounts states at the block
+        Args:
+            states:         Dict {address: {'n_txs': ..., 'eth': ...}}
+            block_number:   Block number of the state
+        Returns:
+            List of upsert operations for bulk write
+        '''
+        operations = []
+        for address, state in states.items():
+            # block goes first: $max compares embedded documents
+            # field by field, so the snapshot with higher block wins
+            snapshot = {'block': block_number,
+                        'n_txs': state['n_txs'],
+                        'eth': state['eth']}
+            operations.append(UpdateOne(
+                {'address': {'$eq': address}},
+                {'$max': {'latest': snapshot},
+                 '$push': {'history': {'$each': [snapshot],
+                                       '$sort': {'block': 1},
+                                       '$slice': -self.history_size}}},
+                upsert=True
+            ))
+        return operations
+
+    def load_states(self, addresses: List[str], block_number: int,
+                    exact: bool = False) -> Dict[str, Dict[str, Any]]:
+        '''
+        Load accounts states at the block
+        Args:
+            addresses:      List of accounts
+            block_number:   Block number
+            exact:          Require snapshot made exactly at the block,
+                            otherwise the latest snapshot <= block is used
+        Returns:
+            Dict {address: {'n_txs': ..., 'eth': ...}}
+        '''
+        states = {}
+        # Usually the latest snapshot is the needed one
+        need_history = []
+        legacy = []
+        latest_docs = self.collection.find(
+            {'address': {'$in': list(addresses)}},
+            {'_id': 0, 'address': 1, 'latest': 1})
+        for doc in latest_docs:
+            latest = doc.get('latest')
+            if latest is None:
+                legacy.append(doc['address'])
+                continue
+            if latest['block'] == block_number or (
+                    not exact and latest['block'] < block_number):
+                states[doc['address']] = {'n_txs': latest['n_txs'],
+                                          'eth': latest['eth']}
+            elif latest['block'] > block_number:
+                need_history.append(doc['address'])
+        if len(legacy) > 0:
+            for doc in self.collection.find({'address': {'$in': legacy}}):
+                state = get_state_at(get_legacy_history(doc),
+                                     block_number, exact)
+                if state is not None:
+                    states[doc['address']] = state
+        if len(need_history) == 0:
+            return states
+
+        query = {'address': {'$in': need_history}}
+        if exact:
+            query['history.block'] = block_number
+        history_docs = self.collection.find(
+            query, {'_id': 0, 'address': 1, 'history': 1})
+        for doc in history_docs:
+            state = get_state_at(doc['history'], block_number, exact)
+            if state is not None:
+                states[doc['address']] = state
+        return states
+
+
+def get_state_at(history: List[Dict[str, Any]], block_number: int,
+                 exact: bool = False) -> Optional[Dict[str, Any]]:
+    ''' Find snapshot at the block in history sorted by block'''
+    blocks = [s['block'] for s in history]
+    i = bisect.bisect_right(blocks, block_number) - 1
+    if i < 0 or (exact and blocks[i] != block_number):
+        return None
+    return {'n_txs': history[i]['n_txs'], 'eth': history[i]['eth']}
+
+
+def get_legacy_history(doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+    ''' Snapshots of the old schema '<block>' fields sorted by block'''
+    return sorted(
+        ({'block': int(k), 'n_txs': v['n_txs'], 'eth': v['eth']}
+         for k, v in doc.items() if k.isdigit()),
+        key=lambda s: s['block'])
+
+
+def migrate_legacy_accounts(collection: Collection,
+                            history_size: int = 128,
+                            batch_size: int = 1000) -> int:
+    '''
+    Convert documents of the old schema {address, '<block>': {n_txs, eth}}
+    to the latest/history schema, keeps last history_size snapshots.
+    Documents already updated by the new code keep their snapshots,
+    the old fields are removed
+    Returns:
+        Number of migrated documents
+    '''
+    migrated = 0
+    operations = []
+    # Old schema only, or both: more fields than address/latest/history
+    query = {'$or': [
+        {'latest': {'$exists': False}},
+        {'$expr': {'$gt': [{'$size': {'$objectToArray': '$$ROOT'}}, 4]}}]}
+    for doc in collection.find(query):
+        legacy_history = get_legacy_history(doc)
+        if len(legacy_history) == 0:
+            continue
+        # Snapshots of the new schema win for the same block
+        snapshots = {s['block']: s for s in legacy_history}
+        snapshots.update((s['block'], s) for s in doc.get('history', []))
+        history = [snapshots[b] for b in sorted(snapshots)][-history_size:]
+        latest = max([history[-1], doc.get('latest', history[-1])],
+                     key=lambda s: s['block'])
+        operations.append(UpdateOne(
+            {'_id': doc['_id']},
+            {'$set': {'latest': latest, 'history': history},
+             '$unset': {k: '' for k in doc if k.isdigit()}}))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+    return migrated
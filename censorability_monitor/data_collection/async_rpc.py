@@ -0,0 +1,224 @@
+import asyncio
+import itertools
+import json
+import logging
+from typing import Any, Dict, List, Sequence, Tuple
+
+import aiohttp
+import websockets
+
+from censorability_monitor.data_collection.concurrency import \
+    AdaptiveConcurrencyLimiter
+from censorability_monitor.data_collection.rpc import (
+    MissingStateError, get_account_calls, is_missing_state_error,
+    match_batch_responses, parse_account_responses)
+from censorability_monitor.data_collection.utils import split_on_chunks
+
+
+class _IPCConnection:
+    def __init__(self, ipc_path: str):
+        self.ipc_path = ipc_path
+        self._reader = None
+        self._writer = None
+
+    async def open(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self.ipc_path, limit=2 ** 26)
+
+    async def call(self, payload: Any) -> Any:
+        self._writer.write(json.dumps(payload).encode('utf-8') + b'\n')
+        await self._writer.drain()
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError('IPC connection closed by the node')
+        return json.loads(line)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class _WSConnection:
+    def __init__(self, ws_url: str):
+        self.ws_url = ws_url
+        self._ws = None
+
+    async def open(self):
+        self._ws = await websockets.connect(self.ws_url, max_size=None)
+
+    async def call(self, payload: Any) -> Any:
+        await self._ws.send(json.dumps(payload))
+        return json.loads(await self._ws.recv())
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+
+
+class _HTTPConnection:
+    def __init__(self, session: aiohttp.ClientSession, http_url: str):
+        self.session = session
+        self.http_url = http_url
+
+    async def open(self):
+        pass
+
+    async def call(self, payload: Any) -> Any:
+        async with self.session.post(self.http_url, json=payload) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def close(self):
+        pass
+
+
+class AsyncRPCClient:
+    '''Asyncio JSON-RPC client for I/O bound fan-out to the node.
+       Keeps a pool of persistent connections (ipc, ws) or a keep-alive
+       HTTP session. The number of in-flight requests is adapted to
+       the node latency, up to max_concurrency'''
+    def __init__(self, web3_type: str, web3_url: str,
+                 max_concurrency: int = 64, timeout: float = 30,
+                 target_latency: float = 1):
+        self.logger = logging.getLogger('AsyncRPCClient')
+        self.web3_type = web3_type
+        self.web3_url = web3_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=max_concurrency // 4, max_limit=max_concurrency,
+            target_latency=target_latency, name='AsyncRPCClient')
+        self._idle = None
+        self._session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        self._idle = asyncio.LifoQueue()
+        if self.web3_type == 'http':
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        elif self.web3_type not in ('ipc', 'ws'):
+            msg = f'Unexpected web3 connection type: {self.web3_type}'
+            self.logger.error(msg)
+            raise Exception(msg)
+
+    async def close(self):
+        while self._idle is not None and not self._idle.empty():
+            await self._idle.get_nowait().close()
+        if self._session is not None:
+            await self._session.close()
+
+    async def _get_connection(self):
+        if not self._idle.empty():
+            return self._idle.get_nowait()
+        if self.web3_type == 'ipc':
+            connection = _IPCConnection(self.web3_url)
+        elif self.web3_type == 'ws':
+            connection = _WSConnection(self.web3_url)
+        else:
+            connection = _HTTPConnection(self._session, self.web3_url)
+        await connection.open()
+        return connection
+
+    async def call(self, payload: Any) -> Any:
+        ''' Send raw JSON-RPC payload (single call or batch)'''
+        async with self.limiter.slot():
+            connection = await self._get_connection()
+            try:
+                response = await asyncio.wait_for(connection.call(payload),
+                                                  self.timeout)
+            except BaseException:
+                # Connection state is unknown - don't reuse it
+                await connection.close()
+                raise
+            self._idle.put_nowait(connection)
+            return response
+
+    async def request(self, method: str, params: List[Any]) -> Any:
+        '''
+        Make JSON-RPC request
+        Returns:
+            Result of the call, raises ValueError if the node returned error
+        '''
+        response = await self.call({'jsonrpc': '2.0', 'method': method,
+                                    'params': params, 'id': next(self._ids)})
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    async def batch_request(self, calls: Sequence[Tuple[str, List[Any]]]
+                            ) -> List[Dict[str, Any]]:
+        ''' Make JSON-RPC batch request, returns raw responses in order
+            of calls, raises ValueError if the node rejected the batch'''
+        if len(calls) == 0:
+            return []
+        payload = [{'jsonrpc': '2.0', 'method': method,
+                    'params': params, 'id': i}
+                   for i, (method, params) in enumerate(calls)]
+        return match_batch_responses(len(calls), await self.call(payload))
+
+
+async def get_accounts_data(client: AsyncRPCClient,
+                            addresses: List[str],
+                            block_number: int,
+                            batch_size: int = 0
+                            ) -> Dict[str, Dict[str, Any]]:
+    '''
+    Get nonce and balance of accounts at the block
+    Args:
+        client:         Async RPC client
+        addresses:      List of accounts
+        block_number:   Block number for the state
+        batch_size:     Number of accounts in one JSON-RPC batch request,
+                        0 - send separate requests
+    Returns:
+        Dict {address: {'n_txs': nonce, 'eth': balance in ETH}}, accounts
+        with failed requests are skipped
+    Raises:
+        MissingStateError if the node doesn't keep the block state
+    '''
+    if batch_size > 0:
+        batches = list(split_on_chunks(list(addresses), batch_size))
+        responses = await asyncio.gather(*[
+            client.batch_request(get_account_calls(batch, block_number))
+            for batch in batches], return_exceptions=True)
+        result = {}
+        for batch, batch_responses in zip(batches, responses):
+            # Accounts of a batch rejected by the node are skipped
+            if isinstance(batch_responses, ValueError):
+                if is_missing_state_error(batch_responses):
+                    raise MissingStateError(batch_responses)
+                continue
+            if isinstance(batch_responses, BaseException):
+                raise batch_responses
+            result.update(parse_account_responses(batch, batch_responses))
+        return result
+
+    block = hex(block_number)
+
+    async def get_account_data(address: str):
+        n_txs, balance = await asyncio.gather(
+            client.request('eth_getTransactionCount', [address, block]),
+            client.request('eth_getBalance', [address, block]))
+        return {'n_txs': int(n_txs, 16), 'eth': int(balance, 16) / 10 ** 18}
+
+    data = await asyncio.gather(*[get_account_data(a) for a in addresses],
+                                return_exceptions=True)
+    result = {}
+    for address, account_data in zip(addresses, data):
+        if isinstance(account_data, ValueError):
+            if is_missing_state_error(account_data):
+                raise MissingStateError(account_data)
+            continue
+        if isinstance(account_data, BaseException):
+            raise account_data
+        result[address] = account_data
+    return result
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from web3.auto import Web3
+from web3.datastructures import AttributeDict
+
+
+class BlockCache:
+    '''Recent blocks with full transaction objects.
+       Each block is requested from the node once with
+       getBlock(n, full_transactions=True), details of txs included
+       into the block don't need separate getTransaction calls.
+       Users of header fields only keep blocks with tx hashes
+       (full_transactions=False). Can be used from executor threads'''
+    def __init__(self, max_size: int = 16, full_transactions: bool = True):
+        self.max_size = max_size
+        self.full_transactions = full_transactions
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def get_block(self, w3: Web3, block_number: int) -> AttributeDict:
+        ''' Block with full transaction objects or tx hashes'''
+        with self._lock:
+            block = self._blocks.get(block_number)
+            if block is not None:
+                self._blocks.move_to_end(block_number)
+                self.hits += 1
+                return block
+            self.misses += 1
+        block = w3.eth.getBlock(block_number,
+                                full_transactions=self.full_transactions)
+        with self._lock:
+            self._blocks[block_number] = block
+            while len(self._blocks) > self.max_size:
+                self._blocks.popitem(last=False)
+        return block
+
+    def get_transactions(self, w3: Web3,
+                         block_number: int) -> Dict[str, AttributeDict]:
+        ''' Transactions included into the block: {hash: transaction},
+            the cache must keep full transactions'''
+        block = self.get_block(w3, block_number)
+        return {tx['hash'].hex(): tx for tx in block['transactions']}
+
+
+def get_block_hashes(block: Dict[str, Any]) -> List[str]:
+    ''' Hashes of block txs, block can have full txs or hashes only'''
+    return [tx.hex() if isinstance(tx, bytes) else tx['hash'].hex()
+            for tx in block['transactions']]
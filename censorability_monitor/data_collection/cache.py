@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Set, Tuple
+
+
+class SeenHashCache:
+    '''Bounded LRU cache of transactions hashes already saved to DB
+       with details. A hash is known only for the window after its first
+       seen timestamp. Known hashes skip the existence query only,
+       re-seen txs are still reset in DB: BlockCollector marks them
+       as included, reverted or dropped'''
+    def __init__(self, max_size: int = 500_000, window: int = 3600):
+        self.max_size = max_size
+        self.window = window
+        self._first_seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._first_seen)
+
+    def is_known(self, tx_hash: str, now: float) -> bool:
+        first_seen = self._first_seen.get(tx_hash)
+        if first_seen is None or now - first_seen >= self.window:
+            self.misses += 1
+            return False
+        self._first_seen.move_to_end(tx_hash)
+        self.hits += 1
+        return True
+
+    def add(self, tx_hash: str, first_seen: int):
+        self._first_seen[tx_hash] = first_seen
+        self._first_seen.move_to_end(tx_hash)
+        while len(self._first_seen) > self.max_size:
+            self._first_seen.popitem(last=False)
+
+
+class AccountStateCache:
+    '''Nonce and balance of accounts at the last applied block.
+       Blocks have to be applied one by one: accounts changed by the block
+       are invalidated. The whole cache is dropped on a gap, on unknown
+       changed accounts and on a reorg: parent hash of the block differs
+       from the hash of the last applied one. Entries older than max_age
+       blocks are refreshed anyway, it bounds staleness when the changed
+       accounts set is not complete'''
+    def __init__(self, max_size: int = 1_000_000, max_age: int = None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.block_number = None
+        self.block_hash = None
+        self._states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def clear(self):
+        self._states.clear()
+        self.block_number = None
+        self.block_hash = None
+
+    def advance(self, block_number: int, changed: Set[str] = None,
+                block_hash: str = None, parent_hash: str = None):
+        '''
+        Move the cache to the state after the block
+        Args:
+            block_number:   Block number
+            changed:        Accounts touched by the block, None if unknown
+            block_hash:     Hash of the block
+            parent_hash:    Parent hash of the block, checked against
+                            the last applied block
+        '''
+        if block_number == self.block_number and (
+                block_hash is None or block_hash == self.block_hash):
+            return
+        if (self.block_number is None or changed is None
+                or block_number != self.block_number + 1
+                or parent_hash is None or parent_hash != self.block_hash):
+            self._states.clear()
+        else:
+            for address in changed:
+                self._states.pop(address, None)
+        self.block_number = block_number
+        self.block_hash = block_hash
+
+    def get_many(self, addresses: List[str]
+                 ) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+        ''' Split addresses on cached states and unknown addresses'''
+        known = {}
+        unknown = []
+        for address in addresses:
+            entry = self._states.get(address)
+            if entry is None or (
+                    self.max_age is not None
+                    and self.block_number - entry[0] >= self.max_age):
+                unknown.append(address)
+                continue
+            self._states.move_to_end(address)
+            known[address] = entry[1]
+        self.hits += len(known)
+        self.misses += len(unknown)
+        return known, unknown
+
+    def update(self, states: Dict[str, Dict[str, Any]]):
+        for address, state in states.items():
+            self._states[address] = (self.block_number, state)
+            self._states.move_to_end(address)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
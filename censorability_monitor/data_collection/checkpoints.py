@@ -0,0 +1,142 @@
+import logging
+import time
+from typing import Any, Dict, Optional, Set
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid
+
+from censorability_monitor.data_collection.writer import WriteBehindWriter
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINTS_COLLECTION = 'stage_checkpoints'
+HISTORY_COLLECTION = 'stage_history'
+# Pipeline stages
+STAGE_BLOCK_INFO = 'block_info_saved'
+STAGE_GAS_ESTIMATED = 'block_gas_estimated'
+STAGE_ANALYTICS = 'analytics'
+# Approximate size of a history document
+HISTORY_DOCUMENT_SIZE = 256
+HISTORY_INDEX = [('stage', ASCENDING), ('block', ASCENDING)]
+
+
+class CheckpointStore:
+    '''Progress of pipeline stages. One watermark document per stage
+       in stage_checkpoints, updated atomically with $min / $max:
+       {
+           _id: stage,
+           first_block: N,
+           last_block: M,
+           updated_ts: ts
+       }
+       Per-block history is kept in the capped stage_history collection
+       if it was created by prepare_checkpoints:
+       {stage: stage, block: N, ts: ts, ...}'''
+    def __init__(self, db: Database):
+        self.collection = db[CHECKPOINTS_COLLECTION]
+        self.history = db[HISTORY_COLLECTION]
+        self.keep_history = self.history.options().get('capped', False)
+
+    def advance(self, stage: str, block_number: int,
+                info: Dict[str, Any] = None,
+                writer: WriteBehindWriter = None):
+        '''
+        Mark the block as processed by the stage
+        Args:
+            stage:          Stage name
+            block_number:   Processed block
+            info:           Fields for the history document
+            writer:         Write-behind writer, the block is marked after
+                            all operations queued before. Written
+                            directly if not set
+        '''
+        ts = int(time.time())
+        operation = UpdateOne(
+            {'_id': stage},
+            {'$max': {'last_block': block_number},
+             '$min': {'first_block': block_number},
+             '$set': {'updated_ts': ts}},
+            upsert=True)
+        history_doc = None
+        if self.keep_history:
+            history_doc = {'stage': stage, 'block': block_number, 'ts': ts,
+                           **(info or {})}
+        if writer is not None:
+            if history_doc is not None:
+                writer.insert_many(HISTORY_COLLECTION, [history_doc])
+            writer.submit(CHECKPOINTS_COLLECTION, [operation])
+            return
+        if history_doc is not None:
+            self.history.insert_one(history_doc)
+        self.collection.bulk_write([operation])
+
+    def get_checkpoint(self, stage: str) -> Optional[Dict[str, Any]]:
+        return self.collection.find_one({'_id': stage})
+
+    def get_last_block(self, stage: str) -> Optional[int]:
+        ''' Highest block processed by the stage, None if there is none'''
+        checkpoint = self.get_checkpoint(stage)
+        return None if checkpoint is None else checkpoint['last_block']
+
+    def get_first_block(self, stage: str) -> Optional[int]:
+        ''' Lowest block processed by the stage, None if there is none'''
+        checkpoint = self.get_checkpoint(stage)
+        return None if checkpoint is None else checkpoint['first_block']
+
+    def get_history_blocks(self, stage: str, start_block: int,
+                           end_block: int) -> Set[int]:
+        ''' Blocks processed by the stage in [start_block, end_block]
+            according to the history, empty without history'''
+        if not self.keep_history:
+            return set()
+        return set(self.history.distinct(
+            'block', {'stage': stage,
+                      'block': {'$gte': start_block, '$lte': end_block}}))
+
+
+def prepare_checkpoints(db: Database, history_size: int = 100_000,
+                        legacy_stages: Dict[str, str] = None):
+    '''
+    Create the capped history collection with its index and seed
+    watermarks of databases written before checkpoints
+    Args:
+        db:             Database
+        history_size:   Max number of history documents, 0 - no history
+        legacy_stages:  Dict {stage: field} of the old processed_blocks
+                        log, used if the stage has no watermark yet
+    '''
+    if history_size > 0:
+        try:
+            db.create_collection(
+                HISTORY_COLLECTION, capped=True, max=history_size,
+                size=history_size * HISTORY_DOCUMENT_SIZE)
+            logger.info(f'{db.name}: created {HISTORY_COLLECTION}')
+        except CollectionInvalid:
+            # Already exists
+            pass
+        history = db[HISTORY_COLLECTION]
+        if history.options().get('capped', False):
+            history.create_index(HISTORY_INDEX)
+        else:
+            logger.warning((f'{db.name}: {HISTORY_COLLECTION} exists and '
+                            'is not capped, stage history is off. Drop '
+                            'the collection to keep history'))
+    checkpoints = db[CHECKPOINTS_COLLECTION]
+    log = db['processed_blocks']
+    for stage, field in (legacy_stages or {}).items():
+        if checkpoints.find_one({'_id': stage}) is not None:
+            continue
+        query = {field: {'$exists': True}}
+        first = log.find_one(query, sort=[(field, 1)])
+        last = log.find_one(query, sort=[(field, -1)])
+        if first is None:
+            continue
+        checkpoints.update_one(
+            {'_id': stage},
+            {'$max': {'last_block': last[field]},
+             '$min': {'first_block': first[field]},
+             '$set': {'updated_ts': int(time.time())}},
+            upsert=True)
+        logger.info((f'{db.name}: {stage} checkpoint seeded from '
+                     f'processed_blocks: {first[field]} - {last[field]}'))
@@ -1,16 +1,58 @@
 import asyncio
-import json
 import logging
+import signal
+import sys
 import time
 from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import current_process
-from typing import List
+from functools import partial
+from multiprocessing import Manager, Process, current_process
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import pandas as pd
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database
 from pymongo.errors import BulkWriteError
 from web3.auto import Web3
-from web3.exceptions import ContractLogicError, TransactionNotFound
+from web3.exceptions import TransactionNotFound
+
+from censorability_monitor.data_collection.accounts import \
+    AccountHistoryStore
+from censorability_monitor.data_collection.async_rpc import (
+    AsyncRPCClient, get_accounts_data)
+from censorability_monitor.data_collection.blocks import BlockCache
+from censorability_monitor.data_collection.cache import (AccountStateCache,
+                                                         SeenHashCache)
+from censorability_monitor.data_collection.checkpoints import (
+    CHECKPOINTS_COLLECTION, STAGE_BLOCK_INFO, STAGE_GAS_ESTIMATED,
+    CheckpointStore, prepare_checkpoints)
+from censorability_monitor.data_collection.concurrency import \
+    AdaptiveConcurrencyLimiter
+from censorability_monitor.data_collection.connection import (
+    WEB3_CONNECTION_TYPES, get_web3_client)
+from censorability_monitor.data_collection.eligibility import (
+    DETAILS_PROJECTION, ELIGIBILITY_COLLECTION, MempoolEligibilityStore,
+    compute_mempool_eligibility, find_eligible_transactions)
+from censorability_monitor.data_collection.estimates import \
+    GasEstimateStore
+from censorability_monitor.data_collection.gas_estimation import (
+    GasEstimateCache, GasEstimationPool, PlainTransferClassifier,
+    sort_by_priority_fee)
+from censorability_monitor.data_collection.handoff import (
+    BlockEvents, change_streams_available, notify_block)
+from censorability_monitor.data_collection.metrics import (
+    CollectorMetrics, MetricsServer, get_limiter_metrics)
+from censorability_monitor.data_collection.rpc import (
+    MissingStateError, get_accounts_data_batch, get_transactions_batch,
+    is_missing_state_error)
+from censorability_monitor.data_collection.subscription import \
+    PendingTransactionsSubscription
+from censorability_monitor.data_collection.txpool import TxPoolTracker
+from censorability_monitor.data_collection.utils import split_on_chunks
+from censorability_monitor.data_collection.writer import WriteBehindWriter
+from censorability_monitor.indexes import (COLLECTOR_INDEXES,
+                                           COLLECTOR_QUERIES,
+                                           check_query_plans, ensure_indexes)
 
 logger = logging.getLogger(__name__)
 
@@ -27,10 +69,55 @@ class DataCollector:
         self.interval = interval
         self.verbose = verbose
         self.name = name
+        self.writer = None
+        self.metrics = CollectorMetrics(interval)
+        # Shared dict (multiprocessing.Manager().dict()) read by
+        # CollectorManager, the collector metrics are under metrics_key
+        self.metrics_store = None
+        self.metrics_key = name
 
     def run(self):
+        # The supervisor stops stalled collectors with SIGTERM: exit
+        # normally, so worker processes are shut down by their executors
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))
         asyncio.run(self.collect())
 
+    def report_iteration(self, duration: float, items: int = 0,
+                         lag_blocks: int = None):
+        '''
+        Update loop metrics shared with CollectorManager
+        Args:
+            duration:   Seconds the loop iteration took
+            items:      Number of items processed
+            lag_blocks: Blocks behind the chain head, None - not tracked
+        '''
+        self.metrics.iteration(duration, items, lag_blocks)
+        self.save_metrics()
+
+    def heartbeat(self):
+        ''' Report that the collector is alive between loop iterations:
+            while waiting for data or processing a long backlog'''
+        self.metrics.heartbeat()
+        self.save_metrics()
+
+    def save_metrics(self):
+        ''' Share metrics with CollectorManager'''
+        logger = logging.getLogger(self.name)
+        if self.metrics_store is None:
+            return
+        metrics = self.metrics.to_dict()
+        metrics.update(self.get_extra_metrics())
+        try:
+            self.metrics_store[self.metrics_key] = metrics
+        except Exception as e:
+            logger.warning(f'Metrics are not saved: {type(e)} {e}')
+
+    def get_extra_metrics(self) -> Dict[str, Any]:
+        ''' Collector specific metrics'''
+        if self.writer is None:
+            return {}
+        return {'write_queue_depth': self.writer.queue_depth}
+
     async def wait_if_needed(self, t1: float):
         logger = logging.getLogger(self.name)
         t2 = time.time()
@@ -42,10 +129,17 @@ class DataCollector:
     def get_mongo_client(self):
         return MongoClient(self.mongo_url)
 
+    def get_writer(self) -> WriteBehindWriter:
+        ''' Start write-behind sink for the collector DB'''
+        writer = WriteBehindWriter(self.mongo_url, self.db_name,
+                                   name=f'{self.name}Writer')
+        writer.start()
+        return writer
+
     def get_web3_client(self):
         logger = logging.getLogger(self.name)
-        if self.web3_type == 'ipc':
-            w3 = Web3(Web3.IPCProvider(self.web3_url))
+        if self.web3_type in WEB3_CONNECTION_TYPES:
+            w3 = get_web3_client(self.web3_type, self.web3_url)
             logger.info(f'Connected to ETH node: {w3.isConnected()}')
             return w3
         else:
@@ -62,9 +156,35 @@ class MempoolCollector(DataCollector):
        and stores the first seen timestamp in MongoDB'''
     def __init__(self, mongo_url: str, db_name: str,
                  web3_type: str, web3_url: str,
-                 interval: float = 0.5, verbose: bool = True):
+                 interval: float = 0.5, verbose: bool = True,
+                 rpc_batch_size: int = 500,
+                 ingestion_mode: str = 'poll',
+                 seen_cache_size: int = 500_000):
         super().__init__(mongo_url, db_name, web3_type, web3_url,
                          interval, verbose, 'MempoolCollector')
+        # 'poll' - poll pending filter and request txs details,
+        # 'subscribe' - get full txs pushed by the node (ipc/ws only),
+        # polling is used as a fallback
+        self.ingestion_mode = ingestion_mode
+        # Hashes saved recently with details: BlockCollector deletes
+        # only txs without details, so they don't need a DB check
+        self.seen_cache = SeenHashCache(max_size=seen_cache_size,
+                                        window=3600)
+        # Max number of getTransaction calls in one JSON-RPC batch,
+        # 0 - request transactions one by one
+        self.rpc_batch_size = rpc_batch_size
+
+    def get_transactions(self, hashes: List[str], w3: Web3):
+        ''' Get transactions details, None for not found ones'''
+        if self.rpc_batch_size > 0:
+            return get_transactions_batch(w3, hashes, self.rpc_batch_size)
+        transactions = {}
+        for tx_hash in hashes:
+            try:
+                transactions[tx_hash] = w3.eth.getTransaction(tx_hash)
+            except TransactionNotFound:
+                transactions[tx_hash] = None
+        return transactions
 
     async def collect(self):
         # Connect to the ETH node and MongoDB
@@ -73,95 +193,179 @@ class MempoolCollector(DataCollector):
         w3 = self.get_web3_client()
         logger.info('Start collecting mempool data')
 
-        # Get the collections
+        # Writes are synchronous: BlockCollector marks included txs
+        # right after the block, a queued insert could land after
+        # the mark and leave the tx in the mempool
         db = mongo_client[self.db_name]
-        first_seen_collection = db['tx_first_seen_ts']
-        tx_details_collection = db['tx_details']
-        first_seen_collection.create_index('hash', unique=True)
-        tx_details_collection.create_index('hash', unique=True)
+        if self.ingestion_mode == 'subscribe':
+            try:
+                await self.collect_from_subscription(w3, db)
+            except Exception as e:
+                logger.error((f'Subscription failed: {type(e)} {e}, '
+                              'fall back to pending filter polling'))
+        await self.collect_from_filter(w3, db)
+
+    async def collect_from_filter(self, w3: Web3, db: Database):
+        ''' Poll new pending transactions hashes from the node filter'''
+        logger = logging.getLogger(self.name)
         tx_filter = w3.eth.filter('pending')
         i = 0
         while True:
             t1 = time.time()
             new_transactions = [tx.hex() for tx in tx_filter.get_new_entries()]
-            n = len(new_transactions)
-            # Find new transactions
-            found_in_db = first_seen_collection.find(
-                {"hash": {"$in": new_transactions}})
-            existing_hashes = [d['hash'] for d in found_in_db]
-
-            # Return dropped txes
-            first_seen_collection.update_many(
-                {'hash': {'$in': existing_hashes}},
-                {'$set': {'dropped': False},
-                 '$unset': {'block_number': ''}}
-            )
-
-            new_hashes = set([h for h in new_transactions
-                              if h not in existing_hashes])
-            # Prepare data for insertion
-            new_transactions_first_seen = [{'hash': h, 'timestamp': int(t1)}
-                                           for h in new_hashes]
-            # Add details to new transactions
-            details_not_found = 0
-            new_transactions_details = []
-            for tx in new_transactions_first_seen:
-                try:
-                    tx_data = w3.eth.getTransaction(tx['hash'])
-                    tx['from'] = tx_data['from']
-                    tx['nonce'] = tx_data['nonce']
-                    if 'maxFeePerGas' in tx_data:
-                        tx['maxFeePerGas'] = tx_data['maxFeePerGas']
-                    else:
-                        tx['maxFeePerGas'] = tx_data['gasPrice']
-                    # Collect all details in the tx_details collection
-                    transaction_dict = dict(**tx_data)
-                    if 'value' in transaction_dict:
-                        transaction_dict['value'] = str(transaction_dict['value']) # noqa E501
-                    transaction_dict['hash'] = transaction_dict['hash'].hex()
-                    new_transactions_details.append(transaction_dict)
-                except TransactionNotFound:
-                    details_not_found += 1
-                    continue
-            n_new_txs = len(new_transactions_first_seen)
-            details_found = n_new_txs - details_not_found
-
-            # Insert new transactions
-            if new_transactions_first_seen:
-                first_seen_collection.insert_many(new_transactions_first_seen)
-            n_inserted = len(new_transactions_first_seen)
-            if self.verbose:
-                logger.info((f'Inserted {n_inserted} new txs, '
-                             f'found {details_found}/{n_new_txs}'
-                             f'txs from {n} total'))
-            # Insert details
-            if new_transactions_details:
-                try:
-                    tx_details_collection.insert_many(
-                        new_transactions_details, ordered=False)
-                except BulkWriteError as bwe:
-                    for err_details in bwe.details['writeErrors']:
-                        if err_details['code'] != 11000:
-                            raise bwe
+            first_seen = {h: int(t1) for h in new_transactions}
+            self.save_transactions(first_seen, {}, w3, db)
             t2 = time.time()
             time_left = self.interval - (t2 - t1)
             if time_left < 0:
                 logger.warning(f'Slow collector: {current_process().name}')
+            self.report_iteration(t2 - t1, len(first_seen))
             i += 1
             if i % 20 == 0:
                 logger.info('Mempool collector alive!')
             await asyncio.sleep(max(time_left, 0))
 
+    async def collect_from_subscription(self, w3: Web3, db: Database):
+        ''' Receive full pending transactions pushed by the node'''
+        logger = logging.getLogger(self.name)
+        async with PendingTransactionsSubscription(
+                self.web3_type, self.web3_url) as subscription:
+            i = 0
+            while True:
+                received = await subscription.receive(self.interval)
+                t1 = time.time()
+                first_seen = {}
+                transactions_data = {}
+                for ts, tx in received:
+                    if isinstance(tx, str):
+                        tx_hash = tx
+                    else:
+                        tx_hash = tx['hash'].hex()
+                        transactions_data[tx_hash] = tx
+                    first_seen.setdefault(tx_hash, ts)
+                self.save_transactions(first_seen, transactions_data, w3, db)
+                self.report_iteration(time.time() - t1, len(first_seen))
+                i += 1
+                if i % 20 == 0:
+                    logger.info('Mempool collector alive!')
+
+    def save_transactions(self, first_seen: Dict[str, int],
+                          transactions_data: Dict[str, Any],
+                          w3: Web3, db: Database):
+        '''
+        Save first seen timestamps and details of pending transactions
+        Args:
+            first_seen:         Dict {hash: first seen timestamp}
+            transactions_data:  Already known transactions details,
+                                details of other txs are requested from node
+        '''
+        logger = logging.getLogger(self.name)
+        first_seen_collection = db['tx_first_seen_ts']
+        n = len(first_seen)
+        # Transactions recently saved with details by this collector
+        # are in DB, no need to look for them
+        now = time.time()
+        new_transactions = []
+        known_hashes = []
+        for tx_hash in first_seen:
+            if self.seen_cache.is_known(tx_hash, now):
+                known_hashes.append(tx_hash)
+            else:
+                new_transactions.append(tx_hash)
+        # Find new transactions
+        existing = {}
+        if new_transactions:
+            found_in_db = first_seen_collection.find(
+                {"hash": {"$in": new_transactions}},
+                {'hash': 1, 'timestamp': 1, 'from': 1})
+            existing = {d['hash']: d for d in found_in_db}
+        existing_hashes = list(existing.keys()) + known_hashes
+
+        # Return dropped, reverted and reorged out txes
+        if existing_hashes:
+            first_seen_collection.update_many(
+                {'hash': {'$in': existing_hashes}},
+                {'$set': {'dropped': False},
+                 '$unset': {'block_number': ''}})
+        for tx_hash, doc in existing.items():
+            if 'from' in doc:
+                self.seen_cache.add(tx_hash, doc['timestamp'])
+
+        new_hashes = set([h for h in new_transactions
+                          if h not in existing])
+        # Prepare data for insertion
+        new_transactions_first_seen = [{'hash': h, 'timestamp': first_seen[h]}
+                                       for h in new_hashes]
+        # Add details to new transactions
+        details_not_found = 0
+        new_transactions_details = []
+        no_data_hashes = [h for h in new_hashes
+                          if h not in transactions_data]
+        if no_data_hashes:
+            transactions_data = dict(transactions_data)
+            transactions_data.update(
+                self.get_transactions(no_data_hashes, w3))
+        for tx in new_transactions_first_seen:
+            tx_data = transactions_data.get(tx['hash'])
+            if tx_data is None:
+                details_not_found += 1
+                continue
+            tx['from'] = tx_data['from']
+            tx['nonce'] = tx_data['nonce']
+            if 'maxFeePerGas' in tx_data:
+                tx['maxFeePerGas'] = tx_data['maxFeePerGas']
+            else:
+                tx['maxFeePerGas'] = tx_data['gasPrice']
+            # Collect all details in the tx_details collection
+            transaction_dict = dict(**tx_data)
+            if 'value' in transaction_dict:
+                transaction_dict['value'] = str(transaction_dict['value'])
+            transaction_dict['hash'] = transaction_dict['hash'].hex()
+            new_transactions_details.append(transaction_dict)
+        n_new_txs = len(new_transactions_first_seen)
+        details_found = n_new_txs - details_not_found
+
+        # Details go first: BlockCollector expects details of txs
+        # with the sender in tx_first_seen_ts
+        insert_new(db['tx_details'], new_transactions_details)
+        # Insert new transactions
+        insert_new(first_seen_collection, new_transactions_first_seen)
+        for tx in new_transactions_first_seen:
+            if 'from' in tx:
+                self.seen_cache.add(tx['hash'], tx['timestamp'])
+        n_inserted = len(new_transactions_first_seen)
+        if self.verbose:
+            logger.info((f'Inserted {n_inserted} new txs, '
+                         f'found {details_found}/{n_new_txs}'
+                         f'txs from {n} total, '
+                         f'{n - len(new_transactions)} known from cache'))
+
+
+def insert_new(collection: Collection, documents: List[Dict[str, Any]]):
+    ''' Insert documents, duplicates of already saved ones are skipped'''
+    if len(documents) == 0:
+        return
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as bwe:
+        for err_details in bwe.details['writeErrors']:
+            if err_details['code'] != 11000:
+                raise bwe
+
 
 class AddressDataCollector:
-    def __init__(self, web3_type: str, web3_url: str):
+    def __init__(self, web3_type: str, web3_url: str,
+                 batch_size: int = 100):
         self.logger = logging.getLogger('AddressDataCollector')
         self.web3_type = web3_type
         self.web3_url = web3_url
+        # Number of addresses in one JSON-RPC batch request,
+        # 0 - request nonce and balance one by one
+        self.batch_size = batch_size
 
     def get_web3_client(self):
-        if self.web3_type == 'ipc':
-            w3 = Web3(Web3.IPCProvider(self.web3_url))
+        if self.web3_type in WEB3_CONNECTION_TYPES:
+            w3 = get_web3_client(self.web3_type, self.web3_url)
             return w3
         else:
             msg = f'Unexpected web3 connection type: {self.web3_type}'
@@ -170,6 +374,9 @@ class AddressDataCollector:
 
     def get_address_data(self, addresses: List[str], block_number: int):
         w3 = self.get_web3_client()
+        if self.batch_size > 0:
+            return get_accounts_data_batch(w3, addresses, block_number,
+                                           self.batch_size)
         result = {}
         for address in addresses:
             try:
@@ -179,94 +386,75 @@ class AddressDataCollector:
                     address, block_number) / 10 ** 18
                 result[address] = {'n_txs': n_transactions,
                                    'eth': eth_account}
-            except ValueError:
-                pass
+            except ValueError as e:
+                # Without the block state all accounts fail the same way
+                if is_missing_state_error(e):
+                    raise MissingStateError(e)
         return result
 
 
-def split_on_chunks(a: List, chunk_size: int):
-    # looping till length l
-    for i in range(0, len(a), chunk_size):
-        yield a[i:i + chunk_size]
-
-
-class GasEstimator:
-    def __init__(self, web3_type: str, web3_url: str):
-        self.logger = logging.getLogger('GasEstimator')
-        self.web3_type = web3_type
-        self.web3_url = web3_url
-
-    def get_web3_client(self):
-        if self.web3_type == 'ipc':
-            w3 = Web3(Web3.IPCProvider(self.web3_url))
-            return w3
-        else:
-            msg = f'Unexpected web3 connection type: {self.web3_type}'
-            self.logger.error(msg)
-            raise Exception(msg)
-
-    def estimate_chunk_gas(self, chunk, block_number):
-        w3 = self.get_web3_client()
-        gas_estimates = {}
-        for tx_details in chunk:
-            tx_hash = tx_details['hash']
-            result = self.estimate_tx_gas(tx_details, block_number, w3)
-            gas_estimates[tx_hash] = {'block_number': block_number,
-                                      'gas': result}
-        return gas_estimates
-
-    def estimate_tx_gas(self, tx_details, block_number, w3):
-        try:
-            tx_data = tx_details.copy()
-            del tx_data['_id']
-            del tx_data['hash']
-            del tx_data['blockHash']
-            del tx_data['blockNumber']
-            del tx_data['r']
-            del tx_data['s']
-            if 'gasPrice' in tx_data and 'maxFeePerGas' in tx_data:
-                del tx_data['gasPrice']
-            json_tx = w3.toJSON(tx_data)
-            json_tx = json.loads(json_tx)
-            est_gas = w3.eth.estimate_gas(
-                json_tx, block_number)
-            return est_gas
-        except ContractLogicError:
-            return 'contract_logic_error'
-        except ValueError as e:
-            if e.args[0]['message'].startswith(
-                    'err: max fee per gas less than block base fee'):
-                return 'low maxFeePerGass'
-            elif e.args[0]['message'] == 'insufficient funds for transfer':
-                return 'not enough eth'
-            elif e.args[0]['message'].startswith(
-                    'invalid opcode'):
-                return 'invalid opcode'
-            elif e.args[0]['message'].startswith(
-                    'gas required exceeds allowance'):
-                return 'low gas limit'
-            elif e.args[0]['message'].startswith(
-                    'invalid jump destination'):
-                return 'invalid jump'
-            elif e.args[0]['message'].startswith(
-                    'contract creation code storage out of gas'):
-                return 'contract creation error'
-            return 'unknown value error'
-
-
 class BlockCollector(DataCollector):
     def __init__(self, mongo_url: str, db_name: str,
                  web3_type: str, web3_url: str,
-                 interval: float = 3, verbose: bool = True):
+                 interval: float = 3, verbose: bool = True,
+                 account_fetch_mode: str = 'async',
+                 max_rpc_concurrency: int = 64,
+                 rpc_batch_size: int = 100,
+                 state_diff_source: str = 'trace',
+                 account_cache_max_age: int = 64,
+                 block_diff_cache_max_age: int = 4,
+                 txpool_resync_interval: float = 600,
+                 backfill_workers: int = 4,
+                 max_backfill_blocks: int = 128,
+                 eligibility_max_age: int = 1800):
         super().__init__(mongo_url, db_name, web3_type, web3_url,
                          interval, verbose, 'BlockCollector')
+        # 'async' - fetch accounts state with asyncio fan-out from
+        # this process, 'process' - use a pool of worker processes
+        self.account_fetch_mode = account_fetch_mode
+        self.max_rpc_concurrency = max_rpc_concurrency
+        # Number of accounts in one JSON-RPC batch, 0 - no batching
+        self.rpc_batch_size = rpc_batch_size
+        self.rpc_client = None
+        # Accounts changed by a block are taken from debug_traceBlock
+        # prestate diff ('trace') or from block txs senders and
+        # recipients ('block'), only they are re-fetched from the node.
+        # A block which trace fails drops the accounts cache, after
+        # max_trace_failures failures in a row 'trace' is turned off.
+        # 'block' misses internal ETH transfers and EIP-7702 authorities
+        # nonces, so cached states live block_diff_cache_max_age blocks
+        self.state_diff_source = state_diff_source
+        self.max_trace_failures = 3
+        self.trace_failures = 0
+        self.block_diff_cache_max_age = block_diff_cache_max_age
+        self.account_cache = AccountStateCache(
+            max_age=account_cache_max_age)
+        if state_diff_source == 'block':
+            self.limit_account_cache_age()
+        self.blocks = BlockCache()
+        # Txpool hashes for dropped txs detection, full txpool content
+        # is requested only on resync
+        self.txpool = TxPoolTracker(resync_interval=txpool_resync_interval)
+        # Missed blocks are backfilled on start with historical state,
+        # blocks older than max_backfill_blocks are skipped: a full
+        # (non-archive) node keeps the state of about 128 recent blocks
+        self.backfill_workers = backfill_workers
+        self.max_backfill_blocks = max_backfill_blocks
+        self.backfill_task = None
+        self.live_idle = None
+        # Queues of downstream stages on the same host, they are
+        # notified when a block is saved (see CollectorManager)
+        self.block_queues = []
+        self.checkpoints = None
+        # Mempool txs eligible for each block are saved for the gas
+        # estimator and analytics, kept for eligibility_max_age blocks
+        self.eligibility_max_age = eligibility_max_age
         self.max_workers = 256
+        self.process_limiter = AdaptiveConcurrencyLimiter(
+            max_limit=self.max_workers, target_latency=10,
+            name='AddressDataCollector')
         self.address_data_collectors = [
-            AddressDataCollector(web3_type, web3_url)
-            for _ in range(self.max_workers)
-        ]
-        self.gas_estimators = [
-            GasEstimator(web3_type, web3_url)
+            AddressDataCollector(web3_type, web3_url, rpc_batch_size)
             for _ in range(self.max_workers)
         ]
 
@@ -274,12 +462,31 @@ class BlockCollector(DataCollector):
         logger = logging.getLogger(self.name)
         mongo_client = self.get_mongo_client()
         w3 = self.get_web3_client()
+        self.writer = self.get_writer()
+        if self.account_fetch_mode == 'async':
+            self.rpc_client = AsyncRPCClient(
+                self.web3_type, self.web3_url,
+                max_concurrency=self.max_rpc_concurrency)
+            await self.rpc_client.open()
 
         last_processed_block = w3.eth.blockNumber - 1
+        # Blocks missed while the collector was down are processed in
+        # background, new blocks are processed by the main loop
+        self.live_idle = asyncio.Event()
+        self.live_idle.set()
+        self.checkpoints = CheckpointStore(mongo_client[self.db_name])
+        missed_blocks = self.get_missed_blocks(last_processed_block)
+        if len(missed_blocks) > 0:
+            logger.info((f'Backfill {len(missed_blocks)} missed blocks '
+                         f'from {missed_blocks[0]} to {missed_blocks[-1]}'))
+            self.backfill_task = asyncio.ensure_future(
+                self.backfill(missed_blocks, w3, mongo_client))
         while True:
             t1 = time.time()
             current_block = w3.eth.blockNumber
+            n_blocks = max(current_block - last_processed_block, 0)
             if current_block > last_processed_block:
+                self.live_idle.clear()
                 for block_number in range(last_processed_block + 1,
                                           current_block + 1):
                     try:
@@ -287,28 +494,319 @@ class BlockCollector(DataCollector):
                             block_number, w3, mongo_client)
                     except Exception as e:
                         logger.info(f'Block {block_number} - {type(e)} {e}')
+                    self.heartbeat()
                 last_processed_block = current_block
+                self.live_idle.set()
             t2 = time.time()
             time_left = self.interval - (t2 - t1)
             if time_left < 0:
                 logger.warning(f'Slow collector: {current_process().name}')
+            self.report_iteration(t2 - t1, n_blocks,
+                                  w3.eth.blockNumber - last_processed_block)
             await asyncio.sleep(max(time_left, 0))
+            await self.writer.throttle()
+
+    def get_missed_blocks(self, last_block: int) -> List[int]:
+        '''
+        Blocks not saved up to the last block
+        Args:
+            last_block: Last block to check
+        Returns:
+            Sorted list of block numbers, starting from the first block ever
+            processed, but not older than max_backfill_blocks
+        '''
+        logger = logging.getLogger(self.name)
+        checkpoint = self.checkpoints.get_checkpoint(STAGE_BLOCK_INFO)
+        if checkpoint is None:
+            return []
+        if not self.checkpoints.keep_history:
+            logger.warning(('No stage history: missed blocks before '
+                            f'the last processed {checkpoint["last_block"]} '
+                            'are not detected'))
+        start_block = max(checkpoint['first_block'],
+                          last_block - self.max_backfill_blocks + 1)
+        processed = self.checkpoints.get_history_blocks(
+            STAGE_BLOCK_INFO, start_block, last_block)
+        if len(processed) > 0:
+            # Blocks older than the history are unknown
+            start_block = max(start_block, min(processed))
+        else:
+            # No history: only blocks after the watermark are missed
+            start_block = max(start_block, checkpoint['last_block'] + 1)
+        return [b for b in range(start_block, last_block + 1)
+                if b not in processed]
+
+    async def backfill(self, blocks: List[int],
+                       w3: Web3, mongo_client: MongoClient):
+        '''
+        Process missed blocks with bounded number of concurrent workers,
+        new blocks processing has priority: a worker doesn't start
+        a block while the main loop is busy. A block without state
+        on the node fails and stays missed
+        '''
+        logger = logging.getLogger(self.name)
+        t1 = time.time()
+        blocks_queue = asyncio.Queue()
+        for block_number in blocks:
+            blocks_queue.put_nowait(block_number)
+        failed = []
+
+        async def worker():
+            while True:
+                await self.live_idle.wait()
+                # Other workers could take the rest while waiting
+                try:
+                    block_number = blocks_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                try:
+                    await self.process_block_data(
+                        block_number, w3, mongo_client, backfill=True)
+                except Exception as e:
+                    failed.append(block_number)
+                    logger.info((f'Backfill block {block_number} - '
+                                 f'{type(e)} {e}'))
+
+        await asyncio.gather(*[worker() for _ in range(
+            min(self.backfill_workers, len(blocks)))])
+        logger.info((f'Backfill of {len(blocks)} blocks done in '
+                     f'{int(time.time() - t1)} s, failed: {len(failed)}'))
+
+    def limit_account_cache_age(self):
+        ''' Shorter cache age for incomplete changed accounts of 'block' '''
+        if (self.account_cache.max_age is None
+                or self.account_cache.max_age
+                > self.block_diff_cache_max_age):
+            self.account_cache.max_age = self.block_diff_cache_max_age
+
+    def get_changed_accounts(self, block_number: int,
+                             w3: Web3) -> Optional[Set[str]]:
+        ''' Accounts which nonce or balance can be changed by the block,
+            None if they are unknown'''
+        logger = logging.getLogger(self.name)
+        if self.state_diff_source == 'trace':
+            try:
+                response = w3.provider.make_request(
+                    'debug_traceBlockByNumber',
+                    [hex(block_number),
+                     {'tracer': 'prestateTracer',
+                      'tracerConfig': {'diffMode': True}}])
+                if 'error' in response:
+                    raise ValueError(response['error'])
+                changed = set()
+                for tx_trace in response['result']:
+                    for side in ('pre', 'post'):
+                        changed.update(Web3.toChecksumAddress(a)
+                                       for a in tx_trace['result'][side])
+                self.trace_failures = 0
+                return changed
+            except Exception as e:
+                self.trace_failures += 1
+                logger.warning((f'State diff of block {block_number} is not '
+                                f'available: {type(e)} {e}, accounts '
+                                'cache is dropped'))
+                if self.trace_failures >= self.max_trace_failures:
+                    logger.warning((f'State diff failed for '
+                                    f'{self.trace_failures} blocks in a '
+                                    'row, use block transactions only'))
+                    self.state_diff_source = 'block'
+                    self.limit_account_cache_age()
+                return None
+        block = self.blocks.get_block(w3, block_number)
+        changed = {block['miner']}
+        for tx in block['transactions']:
+            changed.add(tx['from'])
+            if tx['to'] is not None:
+                changed.add(tx['to'])
+        for withdrawal in block.get('withdrawals', []):
+            changed.add(Web3.toChecksumAddress(withdrawal['address']))
+        return changed
+
+    async def get_accounts_data(self, accounts: List[str],
+                                block_number: int) -> Dict[str, Any]:
+        ''' Get nonce and balance of accounts at the block,
+            only accounts changed since the previous block are fetched'''
+        logger = logging.getLogger(self.name)
+        w3 = self.get_web3_client()
+        event_loop = asyncio.get_event_loop()
+        block = await event_loop.run_in_executor(
+            None, self.blocks.get_block, w3, block_number)
+        if (self.account_cache.block_number == block_number - 1
+                and self.account_cache.block_hash == block['parentHash']):
+            changed = await event_loop.run_in_executor(
+                None, self.get_changed_accounts, block_number, w3)
+        else:
+            changed = None
+        self.account_cache.advance(block_number, changed, block['hash'],
+                                   block['parentHash'])
+        address_data, unknown = self.account_cache.get_many(accounts)
+        fetched = await self.fetch_accounts_data(unknown, block_number)
+        self.account_cache.update(fetched)
+        address_data.update(fetched)
+        logger.info((f'Accounts state: {len(accounts) - len(unknown)} '
+                     f'cached, {len(unknown)} fetched'))
+        return address_data
+
+    async def fetch_accounts_data(self, accounts: List[str],
+                                  block_number: int) -> Dict[str, Any]:
+        ''' Get nonce and balance of accounts at the block from node'''
+        if self.account_fetch_mode == 'async':
+            return await get_accounts_data(self.rpc_client, accounts,
+                                           block_number, self.rpc_batch_size)
+        batch_size = 1000
+        event_loop = asyncio.get_event_loop()
+        chunks = list(split_on_chunks(accounts, batch_size))
+        num_workers = max(min(len(chunks), self.max_workers), 1)
+        address_data = {}
+
+        # Number of chunks requested at once follows the node latency
+        async def fetch_chunk(collector, chunk):
+            async with self.process_limiter.slot():
+                return await event_loop.run_in_executor(
+                    executor, collector.get_address_data, chunk,
+                    block_number)
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            data = await asyncio.gather(*[
+                fetch_chunk(self.address_data_collectors[i % num_workers],
+                            chunk)
+                for i, chunk in enumerate(chunks)])
+        for d in data:
+            address_data.update(d)
+        return address_data
+
+    def get_rpc_metrics(self) -> Dict[str, Any]:
+        ''' Concurrency limit and latency of accounts state requests'''
+        if self.rpc_client is not None:
+            return self.rpc_client.limiter.metrics()
+        return self.process_limiter.metrics()
+
+    def get_extra_metrics(self) -> Dict[str, Any]:
+        metrics = super().get_extra_metrics()
+        metrics.update(get_limiter_metrics(self.get_rpc_metrics()))
+        return metrics
 
     async def process_block_data(self, block_number: int,
-                                 w3: Web3, mongo_client: MongoClient):
+                                 w3: Web3, mongo_client: MongoClient,
+                                 backfill: bool = False):
+        '''
+        Save mempool accounts state before the block and mark txs
+        included in the block
+        Args:
+            block_number:   Block number
+            w3:             Web3 client
+            mongo_client:   MongoDB client
+            backfill:       Block is older than already processed ones:
+                            txs included in later blocks are still
+                            in its mempool, the account cache, reverted
+                            and dropped txs detection are not used
+        '''
         t1 = time.time()
         logger = logging.getLogger(self.name)
         logger.info(f'Start processing block {block_number}')
         db = mongo_client[self.db_name]
         first_seen_collection = db['tx_first_seen_ts']
-        tx_details_collection = db['tx_details']
-        block = w3.eth.getBlock(block_number)
+        # Node and DB calls are blocking, they run in threads so that
+        # backfill workers and new blocks processing overlap
+        event_loop = asyncio.get_event_loop()
+        block = await event_loop.run_in_executor(
+            None, self.blocks.get_block, w3, block_number)
+        block_txs = await event_loop.run_in_executor(
+            None, self.blocks.get_transactions, w3, block_number)
+        mempool_accounts, candidates, found_details, remove_from_mempool = \
+            await event_loop.run_in_executor(
+                None, self.scan_mempool, block_number, block, block_txs,
+                w3, db, backfill)
+
+        # Put found details to db
+        self.writer.insert_many('tx_details', found_details)
+
+        # Remove old enough txs without details
+        await event_loop.run_in_executor(
+            None, first_seen_collection.delete_many,
+            {'hash': {'$in': remove_from_mempool}})
+        logger.info(f'Interesting accs in mempool: {len(mempool_accounts)}')
+
+        # Update accounts info:
+        t2 = time.time()
+        if backfill:
+            address_data = await self.fetch_accounts_data(
+                list(mempool_accounts), block_number - 1)
+        else:
+            address_data = await self.get_accounts_data(
+                list(mempool_accounts), block_number - 1)
+        # Save accounts info to db
+        accounts_store = AccountHistoryStore(db['addresses_info'])
+        self.writer.submit('addresses_info', accounts_store.save_operations(
+            address_data, block_number - 1))
+
+        # Add block number to transactions included in the current block
+        block_hashes = list(block_txs.keys())
+        result = await event_loop.run_in_executor(
+            None, first_seen_collection.update_many,
+            {'hash': {'$in': block_hashes}},
+            {'$set': {'block_number': block_number}})
+        logger.info((f'Updated {result.modified_count} transactions of '
+                     f'{len(block["transactions"])} in block'))
+        logger.info((f'Processing {len(address_data)} addresses '
+                     f'({self.account_fetch_mode}) '
+                     f'took {int(time.time() - t2)} s'))
+
+        # Mempool txs eligible for the block, the estimator and
+        # analytics read them instead of recomputing
+        eligible = await event_loop.run_in_executor(
+            None, self.get_eligible_transactions,
+            candidates, found_details, address_data, db)
+        eligibility_store = MempoolEligibilityStore(
+            db[ELIGIBILITY_COLLECTION], self.eligibility_max_age)
+        self.writer.submit(ELIGIBILITY_COLLECTION,
+                           eligibility_store.save_operations(block_number,
+                                                             eligible))
+        logger.info(f'Eligible for block: {len(eligible)} txs')
+
+        if not backfill:
+            await event_loop.run_in_executor(
+                None, self.remove_stale_transactions, block, block_hashes,
+                address_data, w3, db)
+
+        # Mark the block as saved, the sink writes it
+        # after all queued block data
+        self.checkpoints.advance(STAGE_BLOCK_INFO, block_number,
+                                 writer=self.writer)
+        for block_queue in self.block_queues:
+            self.writer.after_written(partial(notify_block, block_queue,
+                                              block_number))
+
+        rpc_metrics = self.get_rpc_metrics()
+        logger.info((f'Block processing took {int(time.time() - t1)} s, '
+                     f'RPC concurrency {rpc_metrics["limit"]}, latency '
+                     f'p50 {rpc_metrics["latency_p50"]:0.2f} s, '
+                     f'p99 {rpc_metrics["latency_p99"]:0.2f} s'))
+
+    def scan_mempool(self, block_number: int, block: Dict[str, Any],
+                     block_txs: Dict[str, Any], w3: Web3, db: Database,
+                     backfill: bool = False
+                     ) -> Tuple[Set[str], List[str],
+                                List[Dict[str, Any]], List[str]]:
+        '''
+        Mempool txs before the block, details of txs without them
+        are requested from the node
+        Returns:
+            Senders of txs paying the base fee, hashes of these txs,
+            found txs details and hashes of old txs without details
+        '''
+        logger = logging.getLogger(self.name)
+        first_seen_collection = db['tx_first_seen_ts']
         block_ts = block['timestamp']
         # Get transactions from mempool that are not in the blocks
         # and update their from accounts data
-        transactions = first_seen_collection.find(
-            {'timestamp': {'$lte': block_ts},
-             'block_number': {'$exists': False}})
+        mempool_query = {'timestamp': {'$lte': block_ts},
+                         'block_number': {'$exists': False}}
+        if backfill:
+            mempool_query = {'timestamp': {'$lte': block_ts},
+                             '$or': [{'block_number': {'$exists': False}},
+                                     {'block_number': {'$gt': block_number}}]}
+        transactions = first_seen_collection.find(mempool_query)
         # Get mempool accounts and remove old txs without details
         no_details = 0
         n_mempool_txs = 0
@@ -320,11 +818,16 @@ class BlockCollector(DataCollector):
         # Try to find deails for txs without details
         # Get list of addresses with txs with enough gas price
         found_details = []
+        # Txs that can be included into the block by fee
+        candidates = []
         for tx in transactions:
             n_mempool_txs += 1
             if 'from' not in tx:
                 try:
-                    tx_data = w3.eth.getTransaction(tx['hash'])
+                    # Included txs details are already in the block
+                    tx_data = block_txs.get(tx['hash'])
+                    if tx_data is None:
+                        tx_data = w3.eth.getTransaction(tx['hash'])
                     found_tx = {}
                     found_tx['from'] = tx_data['from']
                     found_tx['nonce'] = tx_data['nonce']
@@ -342,6 +845,8 @@ class BlockCollector(DataCollector):
                     transaction_dict['hash'] = transaction_dict['hash'].hex()
                     found_details.append(transaction_dict)
                     old_txs_found += 1
+                    if found_tx['maxFeePerGas'] >= block['baseFeePerGas']:
+                        candidates.append(tx['hash'])
                 except TransactionNotFound:
                     no_details += 1
                 # Remove tx that doesn't have details after 60 seconds
@@ -354,122 +859,57 @@ class BlockCollector(DataCollector):
                 low_fee_txs += 1
                 continue
             mempool_accounts.add(tx['from'])
+            candidates.append(tx['hash'])
         logger.info(f'Found {old_txs_found} old transactions')
-
-        # Put found details to db
-        if found_details:
-            try:
-                tx_details_collection.insert_many(
-                    found_details, ordered=False)
-            except BulkWriteError as bwe:
-                for err_details in bwe.details['writeErrors']:
-                    if err_details['code'] != 11000:
-                        raise bwe
-        n_removed = len(remove_from_mempool)
-
-        # Remove old enough txs without details
-        first_seen_collection.delete_many(
-            {'hash': {'$in': remove_from_mempool}})
         logger.info((f'Found {no_details}/{n_mempool_txs} txs without '
-                     f'details, remove {n_removed} from mempool. '))
-        logger.info(f'Interesting accs in mempool: {len(mempool_accounts)}')
-
-        # Update accounts info:
-        t2 = time.time()
-        batch_size = 1000
-        num_workers = min(len(mempool_accounts) // batch_size + 1,
-                          self.max_workers)
-        process_executor = ProcessPoolExecutor(max_workers=num_workers)
-        event_loop = asyncio.get_event_loop()
-        chunks = list(split_on_chunks(list(mempool_accounts), batch_size))
-        address_data = {}
-        for i in range(0, len(chunks), num_workers):
-            current_chunks = chunks[i:i + num_workers]
-            collection_tasks = [
-                event_loop.run_in_executor(
-                    process_executor,
-                    collector.get_address_data,
-                    chunk,
-                    block_number - 1
-                )
-                for collector, chunk in zip(self.address_data_collectors,
-                                            current_chunks)
-            ]
-            data = await asyncio.gather(*collection_tasks)
-            for d in data:
-                address_data.update(d)
-        # Save accounts info to db
-        accounts_collection = db['addresses_info']
-        accounts_collection.create_index('address', unique=True)
-        accounts_in_db = accounts_collection.find(
-            {'address': {'$in': list(mempool_accounts)}})
-        existing_accounts = {a['address']: a for a in accounts_in_db}
-        new_accounts = [a for a in mempool_accounts
-                        if a not in existing_accounts]
-        insert_records = [{'address': a, str(block_number - 1): address_data[a]
-                           } for a in new_accounts]
-        if len(insert_records) > 0:
-            accounts_collection.insert_many(insert_records)
-
-        update_documents = [
-            UpdateOne(
-                {'address': {'$eq': a}},
-                {'$set':
-                    {f'{block_number - 1}.n_txs': address_data[a]['n_txs'],
-                     f'{block_number - 1}.eth': address_data[a]['eth']}
-                 }
-            )
-            for a in existing_accounts
-        ]
-        if len(update_documents) > 0:
-            accounts_collection.bulk_write(update_documents)
-
-        # Add block number to transactions included in the current block
-        block_hashes = [h.hex() for h in block['transactions']]
-        result = first_seen_collection.update_many(
-            {'hash': {'$in': block_hashes}},
-            {'$set': {'block_number': block_number}})
-        logger.info((f'Updated {result.modified_count} transactions of '
-                     f'{len(block["transactions"])} in block'))
-        logger.info((f'Processing with {num_workers} workers addresses '
-                     f'took {int(time.time() - t2)} s'))
-
+                     f'details, remove {len(remove_from_mempool)} '
+                     f'from mempool. '))
+        return mempool_accounts, candidates, found_details, remove_from_mempool
+
+    def get_eligible_transactions(self, candidates: List[str],
+                                  found_details: List[Dict[str, Any]],
+                                  address_data: Dict[str, Any],
+                                  db: Database) -> List[str]:
+        '''
+        Mempool txs that can be included into the block
+        Args:
+            candidates:     Hashes of mempool txs paying the base fee
+            found_details:  Details fetched for the block, not yet in DB
+            address_data:   Senders state before the block
+            db:             Collector DB
+        Returns:
+            List of eligible txs hashes
+        '''
+        candidates = set(candidates)
+        tx_details = {tx['hash']: tx for tx in found_details
+                      if tx['hash'] in candidates}
+        tx_details.update((tx['hash'], tx) for tx in db['tx_details'].find(
+            {'hash': {'$in': list(candidates - set(tx_details.keys()))}},
+            DETAILS_PROJECTION))
+        return find_eligible_transactions(tx_details.values(), address_data)
+
+    def remove_stale_transactions(self, block: Dict[str, Any],
+                                  block_hashes: List[str],
+                                  address_data: Dict[str, Any],
+                                  w3: Web3, db: Database):
+        ''' Mark reverted and dropped mempool txs after the block'''
+        logger = logging.getLogger(self.name)
+        first_seen_collection = db['tx_first_seen_ts']
+        block_ts = block['timestamp']
         # Remove reverted transactions from future queries
         # We will set block_number -1 for them
 
         transactions = first_seen_collection.find(
             {'timestamp': {'$lte': block_ts},
-             'block_number': {'$exists': False}})
-        # Get list of interesting transactions
-        tx_details = []
-        for tx in transactions:
-            if 'from' not in tx:
-                continue
-            tx_details.append(tx)
-        records = []
-        for tx in tx_details:
-            records.append({'hash': tx['hash'],
-                            'from': tx['from'],
-                            'nonce': tx['nonce']})
+             'block_number': {'$exists': False},
+             'from': {'$exists': True}},
+            {'_id': 0, 'hash': 1, 'from': 1, 'nonce': 1})
+        records = list(transactions)
         if len(records) > 0:
             tx_df = pd.DataFrame.from_records(records)
-            tx_grouped = tx_df.groupby(
-                ['from', 'hash']).agg({'nonce': 'first'})
-            total_reverted = 0
-            reverted_tx_hashes = set()
-            for addr in tx_df['from'].unique():
-                if addr not in address_data:
-                    continue
-                n_txs = address_data[addr]['n_txs']
-                addr_txs = tx_grouped.loc[addr].sort_values(
-                    'nonce', ascending=True
-                    ).reset_index()
-                addr_txs['reverted'] = addr_txs['nonce'] < n_txs
-                reverted = addr_txs['reverted'].sum()
-                reverted_tx_hashes.update(
-                    addr_txs[addr_txs['reverted']]['hash'])
-                total_reverted += reverted
-            logger.info(f'Found {total_reverted} reverted txs')
+            reverted_tx_hashes = find_reverted_transactions(tx_df,
+                                                            address_data)
+            logger.info(f'Found {len(reverted_tx_hashes)} reverted txs')
             # Save result to db
             first_seen_collection.update_many(
                 {'hash': {'$in': list(reverted_tx_hashes)}},
@@ -478,232 +918,181 @@ class BlockCollector(DataCollector):
 
         # Drop transactions that are not in mempool currently
         t_drop = time.time()
-        mempool = w3.geth.txpool.content()
-        mempool_hashes = []
-        for _, v in mempool['queued'].items():
-            for _, w in v.items():
-                mempool_hashes.append(w['hash'])
-        for _, v in mempool['pending'].items():
-            for _, w in v.items():
-                mempool_hashes.append(w['hash'])
+        self.txpool.update(w3, block_hashes)
         # Transactions older than hour without block
         transactions = first_seen_collection.find(
             {'timestamp': {'$lte': time.time() - 3600},
              'block_number': {'$exists': False}
-             })
-        transactions_to_drop = []
-        for tx in transactions:
-            if tx['hash'] not in mempool_hashes:
-                transactions_to_drop.append(tx['hash'])
+             }, {'_id': 0, 'hash': 1})
+        transactions_to_drop = self.txpool.find_dropped(
+            w3, [tx['hash'] for tx in transactions])
         first_seen_collection.update_many(
             {'hash': {'$in': transactions_to_drop}},
             {'$set': {'block_number': -2, 'dropped': True}}
         )
-        logger.info(f'Dropping txes took {time.time() - t_drop:0.2f} sec')
-
-        # Add blocknumber to processed blocks
-        processed_blocks_collection = db['processed_blocks']
-        processed_blocks_collection.insert_one(
-            {'block_info_saved': block_number})
-
-        logger.info(f'Block processing took {int(time.time() - t1)} s')
-
-
-def get_transactions_for_gas_estimation(db, block_number, w3):
-    first_seen_collection = db['tx_first_seen_ts']
-    tx_details_collection = db['tx_details']
-    block = w3.eth.getBlock(block_number)
-    block_ts = block['timestamp']
-    # Get transactions from mempool that are not in the blocks
-    # and update their from accounts data
-    # t1 = time.time()
-    transactions = first_seen_collection.find(
-        {'timestamp': {'$lte': block_ts},
-         '$or': [{'block_number': {'$exists': False}},
-                 {'block_number': {'$gte': block_number}}]
-         })
-    # Get mempool accounts and remove old txs without details
-    n_mempool_txs = 0
-    # Get list of interesting transactions
-    txs_for_gas_estimate = set()
-    for tx in transactions:
-        n_mempool_txs += 1
-        if 'from' not in tx:
-            continue
-        # check that tx maxGasPrice is higher than blocks BaseFeePerGas
-        if ('maxFeePerGas' in tx
-                and tx['maxFeePerGas'] < block['baseFeePerGas']):
-            continue
-        # Put into list for gas estimation
-        txs_for_gas_estimate.add(tx['hash'])
-    # t2 = time.time()
-    # print(f'Interval 1: {t2 - t1:0.2f} - found {len(txs_for_gas_estimate)}')
-
-    # Get details
-    tx_details_collection = db['tx_details']
-    tx_details_db = tx_details_collection.find(
-        {'hash': {'$in': list(txs_for_gas_estimate)}})
-    tx_details = {tx['hash']: tx for tx in tx_details_db}
-    # t3 = time.time()
-    # print(f'Interval 2: {t3 - t2:0.2f}')
-
-    # Fetch address info
-    addresses = set()
-    for _, tx in tx_details.items():
-        addresses.add(tx['from'])
-
-    accounts_collection = db['addresses_info']
-    accounts_details_db = accounts_collection.find(
-        {'address': {'$in': list(addresses)}})
-
-    block_accounts_info = {
-        a['address']: {
-                        'eth': a[str(block_number - 1)]['eth'],
-                        'n_txs': a[str(block_number - 1)]['n_txs']
-                       }
-        for a in accounts_details_db
-        if str(block_number - 1) in a}
-    # print(f'Accounts: {len(block_accounts_info)}')
-    # t4 = time.time()
-    # print(f'Interval 3: {t4 - t3:0.2f}')
-
-    # Make df for nonce analysis
-    records = []
-    for _, tx in tx_details.items():
-        records.append({'hash': tx['hash'],
-                        'from': tx['from'],
-                        'nonce': tx['nonce']})
-
-    tx_df = pd.DataFrame.from_records(records)
-    if len(records) == 0:
-        return []
-    tx_grouped = tx_df.groupby(['from', 'hash']).agg({'nonce': 'first'})
-
-    # t5 = time.time()
-    # print(f'Interval 4: {t5 - t4:0.2f}')
-
-    # Remove transactions that can't be included to block due to high nonce
-    all_nonce_blocked = set()
-    for addr in tx_df['from'].unique():
-        if addr not in block_accounts_info:
-            continue
-        block_txs = False
-        n_txs = block_accounts_info[addr]['n_txs']
-        transactions_from_addr = tx_grouped.loc[addr].sort_values(
-            'nonce', ascending=True
-        ).reset_index()
-        for i, row in transactions_from_addr.iterrows():
-            if row['nonce'] > n_txs:
-                block_txs = True
-                break
-            n_txs += 1
-        if block_txs:
-            nonce_blocked = transactions_from_addr['hash'].values[i:]
-            all_nonce_blocked.update(nonce_blocked)
-
-    non_blocked = tx_df[~tx_df['hash'].isin(all_nonce_blocked)]
-    non_blocked_hashes = non_blocked['hash'].values
-
-    # t6 = time.time()
-    # print(f'Interval 5: {t6 - t5:0.2f}')
-
-    # Remove transactions with not enough value to transfer
-    eligible_transactions = []
-    for tx_hash in non_blocked_hashes:
-        if tx_hash not in tx_details:
-            continue
-        details = tx_details[tx_hash]
-        addr = details['from']
-        if addr not in block_accounts_info:
-            eligible_transactions.append(tx_hash)
-            continue
-        if 'value' in details:
-            value = int(details['value']) / 10 ** 18
-            if value >= block_accounts_info[addr]['eth']:
-                continue
-        eligible_transactions.append(tx_hash)
-    # t7 = time.time()
-    # print(f'Interval 6: {t7 - t6:0.2f}')
-    return eligible_transactions
+        logger.info((f'Dropping {len(transactions_to_drop)} txes of '
+                     f'{len(self.txpool)} tracked in txpool took '
+                     f'{time.time() - t_drop:0.2f} sec'))
+
+
+def find_reverted_transactions(tx_df: pd.DataFrame,
+                               address_data: Dict[str, Any]) -> Set[str]:
+    '''
+    Find transactions with nonce already used by the sender
+    Args:
+        tx_df:          DataFrame with hash, from and nonce columns
+        address_data:   Dict {address: {'n_txs': nonce, ...}}
+    Returns:
+        Set of hashes of reverted transactions
+    '''
+    n_txs = tx_df['from'].map(
+        {a: d['n_txs'] for a, d in address_data.items()})
+    # Senders without account data give NaN and are never reverted
+    reverted = tx_df['nonce'] < n_txs
+    return set(tx_df.loc[reverted, 'hash'])
+
+
+def get_transactions_for_gas_estimation(db, block_number, w3, block=None):
+    ''' Mempool txs that can be included into the block, already fetched
+        block can be passed to avoid an extra request'''
+    if block is None:
+        block = w3.eth.getBlock(block_number)
+    return compute_mempool_eligibility(db, block_number, block)
 
 
 class MemPoolGasEstimator(DataCollector):
     def __init__(self, mongo_url: str, db_name: str,
                  web3_type: str, web3_url: str,
-                 interval: float = 3, verbose: bool = True):
+                 interval: float = 3, verbose: bool = True,
+                 max_workers: int = 32, chunk_size: int = 100,
+                 health_check_interval: float = 60,
+                 gas_cache_max_age: int = 32,
+                 gas_cache_balance_precision: float = 0.1,
+                 gas_cache_max_backoff: int = 64,
+                 batch_estimation: bool = True,
+                 block_deadline: float = 10):
         super().__init__(mongo_url, db_name, web3_type, web3_url,
                          interval, verbose, 'MemPoolGasEstimator')
-        self.max_workers = 256
-        self.gas_estimators = [
-            GasEstimator(web3_type, web3_url)
-            for _ in range(self.max_workers)
-        ]
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.health_check_interval = health_check_interval
+        # Send eth_estimateGas calls of a chunk as one JSON-RPC batch
+        self.batch_estimation = batch_estimation
+        # Seconds for one block estimation, txs with the lowest priority
+        # fee that don't fit into it are skipped
+        self.block_deadline = block_deadline
+        self.gas_estimation_pool = None
+        # Only base fee and timestamp are used, txs are not fetched
+        self.blocks = BlockCache(full_transactions=False)
+        self.gas_cache_max_age = gas_cache_max_age
+        self.gas_cache_balance_precision = gas_cache_balance_precision
+        self.gas_cache_max_backoff = gas_cache_max_backoff
+        self.gas_cache = None
+        self.plain_transfers = PlainTransferClassifier()
+        # Queue notified by BlockCollector on the same host, used if
+        # MongoDB has no change streams
+        self.block_queue = None
+        self.block_events = None
+        self.checkpoints = None
 
     async def collect(self):
         logger = logging.getLogger(self.name)
         mongo_client = self.get_mongo_client()
         w3 = self.get_web3_client()
         db = mongo_client[self.db_name]
-        processed_blocks = db['processed_blocks']
+        self.checkpoints = CheckpointStore(db)
+        self.gas_cache = GasEstimateCache(
+            db['tx_estimated_gas'],
+            max_age=self.gas_cache_max_age,
+            balance_precision=self.gas_cache_balance_precision,
+            max_backoff=self.gas_cache_max_backoff)
+        # Woken up by BlockCollector, interval is the polling fallback
+        self.block_events = BlockEvents(db[CHECKPOINTS_COLLECTION],
+                                        STAGE_BLOCK_INFO, self.block_queue,
+                                        self.name)
 
         # Wait for the first block to be processed
         logger.info('Waiting for processed blocks')
-        total_blocks_prepared = processed_blocks.count_documents(
-                {'block_info_saved': {'$exists': True}})
-        while total_blocks_prepared == 0:
-            total_blocks_prepared = processed_blocks.count_documents(
-                {'block_info_saved': {'$exists': True}})
-            await asyncio.sleep(1)
+        last_block_saved = self.checkpoints.get_last_block(STAGE_BLOCK_INFO)
+        while last_block_saved is None:
+            await self.block_events.wait(self.interval)
+            self.heartbeat()
+            last_block_saved = self.checkpoints.get_last_block(
+                STAGE_BLOCK_INFO)
         logger.info('Waiting for recent (not older 128) processed block')
-        last_block_info_prepared_query = processed_blocks.find().sort(
-                'block_info_saved', -1).limit(1)
-        last_block_info_prepared = next(last_block_info_prepared_query)
-        last_block_saved = last_block_info_prepared['block_info_saved']
         last_eth_block = w3.eth.blockNumber
         while last_eth_block - last_block_saved > 128:
-            last_block_info_prepared_query = processed_blocks.find().sort(
-                'block_info_saved', -1).limit(1)
-            last_block_info_prepared = next(last_block_info_prepared_query)
-            last_block_saved = last_block_info_prepared['block_info_saved']
+            await self.block_events.wait(self.interval)
+            last_block_saved = self.checkpoints.get_last_block(
+                STAGE_BLOCK_INFO)
             last_eth_block = w3.eth.blockNumber
-            await asyncio.sleep(1)
+            self.heartbeat()
         logger.info(f'Starting gas estimation from block {last_block_saved}')
+        self.gas_estimation_pool = GasEstimationPool(
+            self.web3_type, self.web3_url,
+            num_workers=self.max_workers, chunk_size=self.chunk_size,
+            batch_requests=self.batch_estimation)
+        self.gas_estimation_pool.start()
+        last_health_check = time.time()
         current_block = last_block_saved
         last_gas_est_block = current_block - 1
         while True:
             t1 = time.time()
+            n_blocks = max(current_block - last_gas_est_block, 0)
+            if t1 - last_health_check > self.health_check_interval:
+                await self.gas_estimation_pool.check_health()
+                last_health_check = t1
             if current_block > last_gas_est_block:
                 for block_number in range(last_gas_est_block + 1,
                                           current_block + 1):
-                    await self.estimate_gas_for_mempool(
-                        block_number, w3, mongo_client)
-                    processed_blocks.insert_one(
-                        {'block_gas_estimated': block_number})
+                    n_skipped, n_deadline_skipped = \
+                        await self.estimate_gas_for_mempool(
+                            block_number, w3, mongo_client)
+                    self.checkpoints.advance(
+                        STAGE_GAS_ESTIMATED, block_number,
+                        {'skipped_estimations': n_skipped,
+                         'deadline_skipped': n_deadline_skipped})
+                    self.heartbeat()
                 last_gas_est_block = current_block
             t2 = time.time()
             time_left = self.interval - (t2 - t1)
             if time_left < 0:
                 logger.warning(f'Slow collector: {current_process().name}')
-            # logger.info(f'Will wait for {max(time_left, 0)}')
-            await asyncio.sleep(max(time_left, 0))
+            self.report_iteration(t2 - t1, n_blocks,
+                                  w3.eth.blockNumber - last_gas_est_block)
+            # Wait for the next saved block, not longer than the interval
+            await self.block_events.wait(max(time_left, 0))
 
             # Get last processed block
-            last_block_info_prepared_query = processed_blocks.find().sort(
-                'block_info_saved', -1).limit(1)
-            last_block_info_prepared = next(last_block_info_prepared_query)
-            current_block = last_block_info_prepared['block_info_saved']
-            # logger.info(f'Got last saved block: {current_block}')
+            current_block = self.checkpoints.get_last_block(STAGE_BLOCK_INFO)
+
+    def get_extra_metrics(self) -> Dict[str, Any]:
+        metrics = super().get_extra_metrics()
+        if self.gas_estimation_pool is not None:
+            metrics.update(get_limiter_metrics(
+                self.gas_estimation_pool.limiter.metrics()))
+        return metrics
 
     async def estimate_gas_for_mempool(self, block_number: int,
-                                       w3: Web3, mongo_client: MongoClient):
+                                       w3: Web3,
+                                       mongo_client: MongoClient
+                                       ) -> Tuple[int, int]:
+        ''' Estimate gas of mempool txs, returns number of estimations
+            resolved without the node and number of txs skipped due to
+            the block deadline'''
         t1 = time.time()
         logger = logging.getLogger(self.name)
         logger.info(f'Start gas estimation {block_number}')
         db = mongo_client[self.db_name]
 
-        txs_for_gas_estimate = get_transactions_for_gas_estimation(
-            db, block_number, w3
-        )
+        # Saved by BlockCollector, computed here for blocks it didn't save
+        txs_for_gas_estimate = MempoolEligibilityStore(
+            db[ELIGIBILITY_COLLECTION]).load(block_number)
+        if txs_for_gas_estimate is None:
+            logger.info(f'No saved eligible txs for block {block_number}')
+            txs_for_gas_estimate = get_transactions_for_gas_estimation(
+                db, block_number, w3, self.blocks.get_block(w3, block_number)
+            )
         logger.info(f'Complete gathering list: {time.time() - t1:0.2f} sec')
 
         # Estimate gas for txs
@@ -712,65 +1101,219 @@ class MemPoolGasEstimator(DataCollector):
             {'hash': {'$in': list(txs_for_gas_estimate)}}
         )
         transactions_details = [d for d in transactions_details]
-        batch_size = 1000
-        num_workers = min(len(transactions_details) // batch_size + 1,
-                          self.max_workers)
-        process_executor = ProcessPoolExecutor(max_workers=num_workers)
+        senders = list(set(tx['from'] for tx in transactions_details))
+        states = AccountHistoryStore(db['addresses_info']).load_states(
+            senders, block_number - 1, exact=True)
+        # Plain transfers the sender can pay for are resolved locally
+        plain_transfers, transactions_details = self.plain_transfers.split(
+            transactions_details, w3, block_number - 1, states)
+        # Only txs which senders state changed since the last
+        # estimation go to the node
+        estimated_gas, to_estimate = self.gas_cache.split(
+            transactions_details, states, block_number - 1)
+        n_skipped = len(plain_transfers) + len(estimated_gas)
+        # Txs most likely to get into the block go first, the rest is
+        # skipped if the block deadline comes
+        block = self.blocks.get_block(w3, block_number)
+        to_estimate = sort_by_priority_fee(to_estimate,
+                                           block['baseFeePerGas'])
         event_loop = asyncio.get_event_loop()
-        chunks = list(split_on_chunks(list(transactions_details), batch_size))
-        estimated_gas = {}
+        deadline = event_loop.time() + self.block_deadline - (
+            time.time() - t1)
         t_2 = time.time()
-        for i in range(0, len(chunks), num_workers):
-            current_chunks = chunks[i:i + num_workers]
-            collection_tasks = [
-                event_loop.run_in_executor(
-                    process_executor,
-                    estimator.estimate_chunk_gas,
-                    chunk,
-                    block_number - 1
-                )
-                for estimator, chunk in zip(self.gas_estimators,
-                                            current_chunks)
-            ]
-            data = await asyncio.gather(*collection_tasks)
-            for d in data:
-                estimated_gas.update(d)
-        logger.info(f'Estimation: {time.time() - t_2:0.2f} sec')
+        new_estimations, deadline_skipped = \
+            await self.gas_estimation_pool.estimate(
+                to_estimate, block_number - 1, deadline)
+        logger.info((f'Estimation: {time.time() - t_2:0.2f} sec, '
+                     f'skipped {n_skipped}: {len(plain_transfers)} plain '
+                     f'transfers, {len(estimated_gas)} cached, '
+                     f'{len(to_estimate)} sent to node, '
+                     f'{len(deadline_skipped)} missed the deadline'))
+        cache_entries = self.gas_cache.make_entries(
+            to_estimate, new_estimations, states, block_number - 1)
+        estimated_gas.update(new_estimations)
+        estimated_gas.update(plain_transfers)
+        # Skipped txs are marked, gas limit is used for them as for
+        # failed estimations
+        for tx_hash in deadline_skipped:
+            estimated_gas[tx_hash] = {'block_number': block_number - 1,
+                                      'gas': 'skipped'}
         # Save gas estimation to Mongo DB
         tx_gas_collection = db['tx_estimated_gas']
-        tx_gas_collection.create_index('hash')
-        updates = []
-        for tx_hash, gas in estimated_gas.items():
-            updates.append(UpdateOne(
-                {'hash': tx_hash},
-                {'$set': {str(gas['block_number']): gas['gas']}},
-                upsert=True
-            ))
+        updates = GasEstimateStore(tx_gas_collection).save_operations(
+            estimated_gas,
+            {h: {'cache': entry} for h, entry in cache_entries.items()})
         if len(updates) > 0:
             tx_gas_collection.bulk_write(updates)
+        pool_metrics = self.gas_estimation_pool.limiter.metrics()
         logger.info((f'Gas estimation took {int(time.time() - t1)} '
                      f'seconds - got {len(estimated_gas)} of '
-                     f'{len(txs_for_gas_estimate)}'))
+                     f'{len(txs_for_gas_estimate)}, concurrency '
+                     f'{pool_metrics["limit"]}, chunk latency p50 '
+                     f'{pool_metrics["latency_p50"]:0.2f} s, p99 '
+                     f'{pool_metrics["latency_p99"]:0.2f} s'))
+        return n_skipped, len(deadline_skipped)
 
 
 class CollectorManager:
     '''Manages the data collectors.
-       Run them concurrently in a process pool.
+       Runs each collector in its own process and supervises them:
+       a collector that exits or doesn't finish a loop iteration for
+       stall_timeout seconds is restarted with exponential backoff.
+       Collectors metrics are served in Prometheus text format.
        Each collector can use asyncio to run tasks concurrently'''
     def __init__(self, data_collectors: List[DataCollector],
-                 max_workers: int = 8):
+                 checkpoint_history_size: int = 100_000,
+                 metrics_port: int = 9108,
+                 stall_timeout: float = 900,
+                 min_backoff: float = 1,
+                 max_backoff: float = 300,
+                 check_interval: float = 5):
 
-        self.pool_executor = ProcessPoolExecutor(max_workers=max_workers)
         self.data_collectors = data_collectors
+        self.mp_manager = None
+        # Max wake ups queued for the gas estimator, one is enough
+        # to wake it up, it reads the checkpoint itself
+        self.block_queue_size = 1000
+        # Per-block history of stages, 0 - keep watermarks only
+        self.checkpoint_history_size = checkpoint_history_size
+        # Local metrics endpoint port, 0 - no endpoint
+        self.metrics_port = metrics_port
+        self.metrics_store = None
+        self.stall_timeout = stall_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        # Supervisor state of each collector by metrics key
+        self.states = {}
+        names = [c.name for c in data_collectors]
+        for i, collector in enumerate(data_collectors):
+            if names.count(collector.name) > 1:
+                collector.metrics_key = f'{collector.name}_{i}'
+            self.states[collector.metrics_key] = {
+                'collector': collector, 'process': None, 'started_ts': 0,
+                'restart_at': None, 'failures': 0, 'restarts': 0}
+
+    def prepare_databases(self):
+        '''Create checkpoints and indexes and check hot queries plans
+           of collectors DBs'''
+        databases = set((c.mongo_url, c.db_name)
+                        for c in self.data_collectors)
+        for mongo_url, db_name in databases:
+            db = MongoClient(mongo_url)[db_name]
+            prepare_checkpoints(
+                db, self.checkpoint_history_size,
+                {STAGE_BLOCK_INFO: 'block_info_saved',
+                 STAGE_GAS_ESTIMATED: 'block_gas_estimated'})
+            ensure_indexes(db, COLLECTOR_INDEXES)
+            check_query_plans(db, COLLECTOR_QUERIES)
+
+    def connect_stages(self):
+        '''In-process handoff for single-host deploys: BlockCollector
+           notifies MemPoolGasEstimator of the same database through
+           a queue. Connected only if MongoDB has no change streams
+           (standalone server), otherwise nothing would drain the queue'''
+        logger = logging.getLogger('CollectorManager')
+        for estimator in self.data_collectors:
+            if not isinstance(estimator, MemPoolGasEstimator):
+                continue
+            db = MongoClient(estimator.mongo_url)[estimator.db_name]
+            if change_streams_available(db[CHECKPOINTS_COLLECTION]):
+                continue
+            block_collectors = [
+                c for c in self.data_collectors
+                if isinstance(c, BlockCollector)
+                and (c.mongo_url, c.db_name) == (estimator.mongo_url,
+                                                 estimator.db_name)]
+            if len(block_collectors) == 0:
+                continue
+            if self.mp_manager is None:
+                self.mp_manager = Manager()
+            estimator.block_queue = self.mp_manager.Queue(
+                maxsize=self.block_queue_size)
+            logger.info((f'{estimator.db_name}: no change streams, '
+                         'gas estimator is notified through a queue'))
+            for block_collector in block_collectors:
+                block_collector.block_queues.append(estimator.block_queue)
+
+    def start_collector(self, key: str):
+        state = self.states[key]
+        self.metrics_store.pop(key, None)
+        process = Process(target=state['collector'].run, name=key)
+        process.start()
+        state.update(process=process, started_ts=time.time(),
+                     restart_at=None)
+
+    def stop_collector(self, key: str, timeout: float = 10):
+        process = self.states[key]['process']
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def is_stalled(self, key: str, now: float) -> bool:
+        ''' No loop iteration or heartbeat for stall_timeout seconds'''
+        last_iteration_ts = self.metrics_store.get(key, {}).get(
+            'last_iteration_timestamp_seconds', 0)
+        started_ts = self.states[key]['started_ts']
+        return now - max(last_iteration_ts, started_ts) > self.stall_timeout
+
+    def get_metrics(self) -> Dict[str, Dict[str, Any]]:
+        ''' Metrics of each collector: {key: {metric: value}}'''
+        stored = dict(self.metrics_store)
+        metrics = {}
+        for key, state in self.states.items():
+            collector_metrics = dict(stored.get(key, {}))
+            process = state['process']
+            collector_metrics['up'] = int(
+                state['restart_at'] is None
+                and process is not None and process.is_alive())
+            collector_metrics['restarts_total'] = state['restarts']
+            metrics[key] = collector_metrics
+        return metrics
+
+    async def supervise(self):
+        '''Restart exited and stalled collectors, backoff doubles with
+           each failure in a row and is reset after max_backoff seconds
+           of work'''
+        logger = logging.getLogger('CollectorManager')
+        while True:
+            now = time.time()
+            for key, state in self.states.items():
+                if state['restart_at'] is not None:
+                    if now >= state['restart_at']:
+                        logger.info(f'Restarting {key}')
+                        self.start_collector(key)
+                    continue
+                process = state['process']
+                if not process.is_alive():
+                    reason = f'exited with code {process.exitcode}'
+                elif self.is_stalled(key, now):
+                    reason = f'stalled for {self.stall_timeout} s'
+                    self.stop_collector(key)
+                else:
+                    continue
+                if now - state['started_ts'] > self.max_backoff:
+                    state['failures'] = 0
+                backoff = min(self.min_backoff * 2 ** state['failures'],
+                              self.max_backoff)
+                state['failures'] += 1
+                state['restarts'] += 1
+                state['restart_at'] = now + backoff
+                logger.error(f'{key} {reason}, restart in {backoff:.0f} s')
+            await asyncio.sleep(self.check_interval)
 
     async def start(self):
-        '''Start the data collectors in a fire and forget manner'''
-        self.event_loop = asyncio.get_event_loop()
-        collection_tasks = [
-            self.event_loop.run_in_executor(
-                self.pool_executor,
-                collector.run,
-            )
-            for collector in self.data_collectors
-        ]
-        await asyncio.gather(*collection_tasks)
+        '''Start the data collectors and supervise them'''
+        self.prepare_databases()
+        self.connect_stages()
+        if self.mp_manager is None:
+            self.mp_manager = Manager()
+        self.metrics_store = self.mp_manager.dict()
+        for key, state in self.states.items():
+            state['collector'].metrics_store = self.metrics_store
+            self.start_collector(key)
+        if self.metrics_port:
+            MetricsServer(self.get_metrics, port=self.metrics_port).start()
+        await self.supervise()
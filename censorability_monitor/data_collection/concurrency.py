@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+
+class AdaptiveConcurrencyLimiter:
+    '''Limit of in-flight node requests adjusted to the node response (AIMD).
+       Each request that completes in time increases the limit by
+       1 / limit (about +1 per round of requests). A failed or slower than
+       target_latency request cuts the limit by decrease_factor, at most
+       once per the latency of that request, so a burst of failures of one
+       round counts once. Latencies of the last window requests are kept
+       for p50 / p99 metrics'''
+    def __init__(self, initial_limit: int = 16,
+                 min_limit: int = 1, max_limit: int = 256,
+                 target_latency: float = 1,
+                 decrease_factor: float = 0.5,
+                 window: int = 1000,
+                 name: str = 'AdaptiveConcurrencyLimiter'):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.name = name
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._condition = None
+        self.in_flight = 0
+        # Metrics
+        self.requests = 0
+        self.errors = 0
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, latency: Optional[float], error: bool = False):
+        '''
+        Free the slot and adjust the limit
+        Args:
+            latency:    Seconds the request took, None - request
+                        wasn't sent, the limit is kept
+            error:      Request failed (timeout, connection error)
+        '''
+        if latency is not None:
+            self._update(latency, error)
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _update(self, latency: float, error: bool):
+        self.requests += 1
+        self._latencies.append(latency)
+        now = time.monotonic()
+        if error or latency > self.target_latency:
+            self.errors += int(error)
+            if now - self._last_decrease > latency:
+                self._limit = max(self.min_limit,
+                                  self._limit * self.decrease_factor)
+                self._last_decrease = now
+                self.decreases += 1
+                logger = logging.getLogger(self.name)
+                logger.info((f'Concurrency limit {self.limit}: '
+                             f'{"error" if error else "slow request"} '
+                             f'{latency:0.2f} s'))
+        else:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    @asynccontextmanager
+    async def slot(self):
+        ''' Run a request in a slot, exceptions count as errors'''
+        await self.acquire()
+        t1 = time.monotonic()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            await self.release(time.monotonic() - t1, error)
+
+    def get_percentile(self, q: float) -> float:
+        if len(self._latencies) == 0:
+            return 0.0
+        latencies = sorted(self._latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'limit': self.limit,
+                'in_flight': self.in_flight,
+                'latency_p50': self.get_percentile(0.5),
+                'latency_p99': self.get_percentile(0.99),
+                'requests': self.requests,
+                'errors': self.errors,
+                'decreases': self.decreases}
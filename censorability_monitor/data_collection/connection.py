@@ -0,0 +1,58 @@
+import os
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from web3.auto import Web3
+
+WEB3_CONNECTION_TYPES = ('ipc', 'http', 'ws')
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def make_web3_client(web3_type: str, web3_url: str,
+                     pool_size: int = 64, timeout: int = 30) -> Web3:
+    '''
+    Create Web3 client with persistent connection to the node
+    Args:
+        web3_type:  Connection type - ipc, http or ws
+        web3_url:   IPC path or HTTP/WebSocket endpoint
+        pool_size:  Max number of kept alive HTTP connections
+        timeout:    Request timeout in seconds
+    Returns:
+        Web3 client
+    '''
+    if web3_type == 'ipc':
+        return Web3(Web3.IPCProvider(web3_url, timeout=timeout))
+    elif web3_type == 'http':
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return Web3(Web3.HTTPProvider(web3_url, session=session,
+                                      request_kwargs={'timeout': timeout}))
+    elif web3_type == 'ws':
+        return Web3(Web3.WebsocketProvider(
+            web3_url, websocket_timeout=timeout,
+            websocket_kwargs={'max_size': None}))
+    raise Exception(f'Unexpected web3 connection type: {web3_type}')
+
+
+def get_web3_client(web3_type: str, web3_url: str) -> Web3:
+    ''' Get long-lived Web3 client, one per process and node endpoint'''
+    # pid is a part of the key: forked workers must not share
+    # sockets of the parent process
+    key = (os.getpid(), web3_type, web3_url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = make_web3_client(web3_type, web3_url)
+        return _clients[key]
+
+
+def reset_web3_client(web3_type: str, web3_url: str):
+    ''' Drop cached client, the next call creates a new connection'''
+    key = (os.getpid(), web3_type, web3_url)
+    with _clients_lock:
+        _clients.pop(key, None)
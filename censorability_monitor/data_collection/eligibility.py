@@ -0,0 +1,119 @@
+from collections import defaultdict
+from operator import itemgetter
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson.binary import Binary
+from pymongo import DeleteMany, ReplaceOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from censorability_monitor.data_collection.accounts import \
+    AccountHistoryStore
+
+ELIGIBILITY_COLLECTION = 'mempool_eligibility'
+# Fields of tx_details needed for eligibility
+DETAILS_PROJECTION = {'_id': 0, 'hash': 1, 'from': 1, 'nonce': 1, 'value': 1}
+
+
+def find_eligible_transactions(transactions: Iterable[Dict[str, Any]],
+                               states: Dict[str, Dict[str, Any]]
+                               ) -> List[str]:
+    '''
+    Mempool txs that can be included into the block
+    Args:
+        transactions:   Txs details with hash, from, nonce and value
+        states:         Senders state before the block
+                        {address: {'n_txs': ..., 'eth': ...}}
+    Returns:
+        Hashes of txs without a nonce gap before them and with enough
+        balance to transfer the value, txs of unknown senders are eligible
+    '''
+    sender_txs = defaultdict(list)
+    for tx in transactions:
+        sender_txs[tx['from']].append(tx)
+    eligible = []
+    for sender, txs in sender_txs.items():
+        state = states.get(sender)
+        if state is None:
+            eligible.extend(tx['hash'] for tx in txs)
+            continue
+        n_txs = state['n_txs']
+        for tx in sorted(txs, key=itemgetter('nonce')):
+            # Nonce gap: this and the next txs of the sender
+            # can't be included
+            if tx['nonce'] > n_txs:
+                break
+            n_txs += 1
+            if 'value' in tx and int(tx['value']) / 10 ** 18 >= state['eth']:
+                continue
+            eligible.append(tx['hash'])
+    return eligible
+
+
+def compute_mempool_eligibility(db: Database, block_number: int,
+                                block: Dict[str, Any],
+                                exact_states: bool = True) -> List[str]:
+    '''
+    Mempool txs that can be included into the block from the collector DB,
+    used if BlockCollector didn't save them
+    Args:
+        db:             Collector DB
+        block_number:   Block number
+        block:          Block
+        exact_states:   Use only senders states saved exactly before
+                        the block, otherwise the latest saved states
+                        are used for the rest of senders
+    Returns:
+        List of eligible txs hashes
+    '''
+    # Mempool txs that are not in the previous blocks
+    # and pay at least the base fee
+    transactions = db['tx_first_seen_ts'].find(
+        {'timestamp': {'$lte': block['timestamp']},
+         '$or': [{'block_number': {'$exists': False}},
+                 {'block_number': {'$gte': block_number}}]},
+        {'_id': 0, 'hash': 1, 'from': 1, 'maxFeePerGas': 1})
+    candidates = [tx['hash'] for tx in transactions
+                  if 'from' in tx
+                  and tx.get('maxFeePerGas',
+                             block['baseFeePerGas']) >= block['baseFeePerGas']]
+    tx_details = list(db['tx_details'].find(
+        {'hash': {'$in': candidates}}, DETAILS_PROJECTION))
+    senders = list(set(tx['from'] for tx in tx_details))
+    accounts_store = AccountHistoryStore(db['addresses_info'])
+    states = accounts_store.load_states(senders, block_number - 1, exact=True)
+    not_found = set(senders) - set(states.keys())
+    if not exact_states and not_found:
+        states.update(accounts_store.load_states(list(not_found),
+                                                 block_number))
+    return find_eligible_transactions(tx_details, states)
+
+
+class MempoolEligibilityStore:
+    '''Mempool txs eligible for inclusion into blocks, computed once by
+       BlockCollector when it saves the block. One document per block,
+       hashes are packed as 32 bytes each:
+       {_id: block_number, n_txs: N, hashes: Binary}
+       Only max_age recent blocks are kept'''
+    def __init__(self, collection: Collection, max_age: int = 1800):
+        self.collection = collection
+        self.max_age = max_age
+
+    def save_operations(self, block_number: int,
+                        hashes: List[str]) -> List[Any]:
+        ''' Write operations to save the block eligible txs and remove
+            old blocks'''
+        packed = b''.join(bytes.fromhex(h[2:]) for h in hashes)
+        return [ReplaceOne({'_id': block_number},
+                           {'n_txs': len(hashes), 'hashes': Binary(packed)},
+                           upsert=True),
+                DeleteMany({'_id': {'$lt': block_number - self.max_age}})]
+
+    def load(self, block_number: int) -> Optional[List[str]]:
+        ''' Eligible txs hashes of the block, None if not saved'''
+        doc = self.collection.find_one({'_id': block_number})
+        if doc is None:
+            return None
+        packed = bytes(doc['hashes'])
+        return ['0x' + packed[i:i + 32].hex()
+                for i in range(0, len(packed), 32)]
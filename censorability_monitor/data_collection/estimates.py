@@ -0,0 +1,139 @@
+import bisect
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+
+class GasEstimateStore:
+    '''Gas estimations history in tx_estimated_gas collection.
+       One document per transaction, estimations are stored as
+       change points - ranges of blocks with the same value:
+       {
+           hash: '0x...',
+           estimates: [{from: N, to: M, gas: ...}, ...]
+       }
+       ranges are sorted by block and don't overlap. Old documents keep
+       estimations in '<block_number>' fields, they are read as well'''
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    def save_operations(self, estimations: Dict[str, Dict[str, Any]],
+                        extra_fields: Dict[str, Dict[str, Any]] = None
+                        ) -> List[UpdateOne]:
+        '''
+        Write operations to save estimations
+        Args:
+            estimations:    Dict {hash: {'block_number': N, 'gas': value}}
+            extra_fields:   Dict {hash: {field: value}} to set as well
+        Returns:
+            List of upsert operations for bulk write. The block is set
+            in place: a range covering it is split, a range with the same
+            value next to it is extended, so ranges stay sorted and
+            don't overlap
+        '''
+        extra_fields = extra_fields or {}
+        operations = []
+        for tx_hash, estimation in estimations.items():
+            block = estimation['block_number']
+            gas = {'$literal': estimation['gas']}
+            # Range covering the block is split around it,
+            # the new value is merged with equal neighbours
+            split = {'$let': {
+                'vars': {'covering': {'$filter': {
+                    'input': '$$estimates',
+                    'cond': {'$and': [{'$lte': ['$$this.from', block]},
+                                      {'$gte': ['$$this.to', block]}]}}}},
+                'in': {
+                    'left': {'$concatArrays': [
+                        {'$filter': {'input': '$$estimates',
+                                     'cond': {'$lt': ['$$this.to', block]}}},
+                        {'$map': {
+                            'input': {'$filter': {
+                                'input': '$$covering',
+                                'cond': {'$lt': ['$$this.from', block]}}},
+                            'in': {'from': '$$this.from', 'to': block - 1,
+                                   'gas': '$$this.gas'}}}]},
+                    'right': {'$concatArrays': [
+                        {'$map': {
+                            'input': {'$filter': {
+                                'input': '$$covering',
+                                'cond': {'$gt': ['$$this.to', block]}}},
+                            'in': {'from': block + 1, 'to': '$$this.to',
+                                   'gas': '$$this.gas'}}},
+                        {'$filter': {
+                            'input': '$$estimates',
+                            'cond': {'$gt': ['$$this.from', block]}}}]}}}}
+            merged = {'$let': {
+                'vars': {'prev': {'$arrayElemAt': ['$$split.left', -1]},
+                         'next': {'$arrayElemAt': ['$$split.right', 0]}},
+                'in': {'$let': {
+                    'vars': {
+                        'merge_prev': {'$and': [
+                            {'$eq': ['$$prev.to', block - 1]},
+                            {'$eq': ['$$prev.gas', gas]}]},
+                        'merge_next': {'$and': [
+                            {'$eq': ['$$next.from', block + 1]},
+                            {'$eq': ['$$next.gas', gas]}]}},
+                    'in': {'$concatArrays': [
+                        {'$filter': {
+                            'input': '$$split.left',
+                            'cond': {'$or': [
+                                {'$not': ['$$merge_prev']},
+                                {'$ne': ['$$this.from', '$$prev.from']}]}}},
+                        [{'from': {'$cond': ['$$merge_prev',
+                                             '$$prev.from', block]},
+                          'to': {'$cond': ['$$merge_next',
+                                           '$$next.to', block]},
+                          'gas': gas}],
+                        {'$filter': {
+                            'input': '$$split.right',
+                            'cond': {'$or': [
+                                {'$not': ['$$merge_next']},
+                                {'$ne': ['$$this.from', '$$next.from']}]}}}
+                    ]}}}}}
+            fields = {'estimates': {'$let': {
+                'vars': {'estimates': {'$ifNull': ['$estimates', []]}},
+                'in': {'$let': {'vars': {'split': split},
+                                'in': merged}}}}}
+            for field, value in extra_fields.get(tx_hash, {}).items():
+                fields[field] = {'$literal': value}
+            operations.append(UpdateOne({'hash': tx_hash},
+                                        [{'$set': fields}],
+                                        upsert=True))
+        return operations
+
+    def load_estimates(self, hashes: List[str],
+                       block_number: int) -> Dict[str, Any]:
+        '''
+        Load estimations made at the block
+        Args:
+            hashes:         List of transactions hashes
+            block_number:   Block number of the state for estimation
+        Returns:
+            Dict {hash: estimation}, txs without estimation are skipped
+        '''
+        legacy_field = str(block_number)
+        docs = self.collection.find(
+            {'hash': {'$in': list(hashes)}},
+            {'_id': 0, 'hash': 1, legacy_field: 1,
+             'estimates': {'$elemMatch': {'from': {'$lte': block_number},
+                                          'to': {'$gte': block_number}}}})
+        estimations = {}
+        for doc in docs:
+            gas = get_estimate_at(doc.get('estimates', []), block_number)
+            if gas is None:
+                gas = doc.get(legacy_field)
+            if gas is not None:
+                estimations[doc['hash']] = gas
+        return estimations
+
+
+def get_estimate_at(estimates: List[Dict[str, Any]],
+                    block_number: int) -> Optional[Any]:
+    ''' Find estimation at the block in ranges sorted by block'''
+    starts = [e['from'] for e in estimates]
+    i = bisect.bisect_right(starts, block_number) - 1
+    if i < 0 or estimates[i]['to'] < block_number:
+        return None
+    return estimates[i]['gas']
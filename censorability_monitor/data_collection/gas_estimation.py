@@ -0,0 +1,596 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+from threading import BrokenBarrierError
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo.collection import Collection
+from web3.auto import Web3
+from web3.exceptions import ContractLogicError
+
+from censorability_monitor.data_collection.concurrency import \
+    AdaptiveConcurrencyLimiter
+from censorability_monitor.data_collection.connection import (
+    WEB3_CONNECTION_TYPES, get_web3_client, reset_web3_client)
+from censorability_monitor.data_collection.rpc import (
+    get_code_presence_batch, make_batch_request)
+from censorability_monitor.data_collection.utils import split_on_chunks
+
+# Gas of a value transfer to an account without code
+PLAIN_TRANSFER_GAS = 21000
+# Precompiled contracts have no code, but calls to them cost more
+MAX_PRECOMPILE_ADDRESS = 0xff
+
+
+# Node error message prefix -> estimation result
+ESTIMATION_ERRORS = [
+    ('execution reverted', 'contract_logic_error'),
+    ('err: max fee per gas less than block base fee', 'low maxFeePerGass'),
+    ('insufficient funds for transfer', 'not enough eth'),
+    ('invalid opcode', 'invalid opcode'),
+    ('gas required exceeds allowance', 'low gas limit'),
+    ('invalid jump destination', 'invalid jump'),
+    ('contract creation code storage out of gas', 'contract creation error'),
+]
+
+
+def get_estimation_error(message: str) -> str:
+    ''' Map node error message to estimation result'''
+    for prefix, result in ESTIMATION_ERRORS:
+        if message.startswith(prefix):
+            return result
+    return 'unknown value error'
+
+
+# Result of txs which chunk failed in the worker
+CHUNK_ERROR = 'estimation failed'
+# Results that don't depend on the sender state: base fee changes each
+# block, worker and unknown node errors are transient
+UNCACHED_RESULTS = {'low maxFeePerGass', 'unknown value error',
+                    CHUNK_ERROR}
+
+
+def to_rpc_quantities(tx_data: Dict[str, Any]) -> Dict[str, Any]:
+    ''' Encode integer fields as hex quantities for raw JSON-RPC calls'''
+    return {k: hex(v) if isinstance(v, int) and not isinstance(v, bool)
+            else v
+            for k, v in tx_data.items()}
+
+
+class GasEstimator:
+    def __init__(self, web3_type: str, web3_url: str,
+                 batch_requests: bool = True):
+        self.logger = logging.getLogger('GasEstimator')
+        self.web3_type = web3_type
+        self.web3_url = web3_url
+        # Send each chunk as one JSON-RPC batch of eth_estimateGas calls
+        self.batch_requests = batch_requests
+
+    def get_web3_client(self):
+        if self.web3_type in WEB3_CONNECTION_TYPES:
+            w3 = get_web3_client(self.web3_type, self.web3_url)
+            return w3
+        else:
+            msg = f'Unexpected web3 connection type: {self.web3_type}'
+            self.logger.error(msg)
+            raise Exception(msg)
+
+    def estimate_chunk_gas(self, chunk, block_number, deadline=None):
+        ''' Estimate gas of the chunk txs, with the deadline (time.time())
+            txs not estimated before it are left out of the result'''
+        if deadline is not None and time.time() >= deadline:
+            return {}
+        w3 = self.get_web3_client()
+        results = None
+        if self.batch_requests:
+            try:
+                results = self.estimate_batch_gas(chunk, block_number, w3)
+            except ValueError as e:
+                # The node rejected the whole batch
+                self.logger.warning(f'Batch estimation failed: {e}')
+        if results is None:
+            results = []
+            for tx_details in chunk:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                results.append(
+                    self.estimate_tx_gas(tx_details, block_number, w3))
+        gas_estimates = {}
+        for tx_details, result in zip(chunk, results):
+            gas_estimates[tx_details['hash']] = {'block_number': block_number,
+                                                 'gas': result}
+        return gas_estimates
+
+    def prepare_tx(self, tx_details, w3):
+        ''' Transaction details from DB as eth_estimateGas parameter'''
+        tx_data = tx_details.copy()
+        del tx_data['_id']
+        del tx_data['hash']
+        del tx_data['blockHash']
+        del tx_data['blockNumber']
+        del tx_data['r']
+        del tx_data['s']
+        if 'gasPrice' in tx_data and 'maxFeePerGas' in tx_data:
+            del tx_data['gasPrice']
+        # Value is saved to DB as a decimal string
+        if isinstance(tx_data.get('value'), str):
+            tx_data['value'] = int(tx_data['value'])
+        json_tx = w3.toJSON(tx_data)
+        return json.loads(json_tx)
+
+    def estimate_batch_gas(self, chunk, block_number, w3):
+        ''' Estimate gas for the chunk with one JSON-RPC batch request'''
+        calls = [('eth_estimateGas',
+                  [to_rpc_quantities(self.prepare_tx(tx_details, w3)),
+                   hex(block_number)])
+                 for tx_details in chunk]
+        results = []
+        for response in make_batch_request(w3, calls):
+            if 'error' in response:
+                results.append(
+                    get_estimation_error(response['error']['message']))
+            else:
+                results.append(int(response['result'], 16))
+        return results
+
+    def estimate_tx_gas(self, tx_details, block_number, w3):
+        try:
+            json_tx = self.prepare_tx(tx_details, w3)
+            est_gas = w3.eth.estimate_gas(
+                json_tx, block_number)
+            return est_gas
+        except ContractLogicError:
+            return 'contract_logic_error'
+        except ValueError as e:
+            if not isinstance(e.args[0], dict):
+                return 'unknown value error'
+            return get_estimation_error(e.args[0]['message'])
+
+
+# Estimator of the current worker process of GasEstimationPool
+_worker_estimator = None
+
+
+def _init_worker(web3_type: str, web3_url: str, batch_requests: bool):
+    global _worker_estimator
+    _worker_estimator = GasEstimator(web3_type, web3_url, batch_requests)
+    # Open the node connection once, when the worker starts
+    _worker_estimator.get_web3_client()
+
+
+def _estimate_chunk_gas(chunk: List[Dict[str, Any]], block_number: int,
+                        deadline: Optional[float] = None):
+    return _worker_estimator.estimate_chunk_gas(chunk, block_number,
+                                                deadline)
+
+
+def _check_worker_health(barrier: Any, timeout: float) -> bool:
+    ''' Check node connection of the worker, reconnect if it is lost.
+        Each worker is blocked on the barrier until all workers
+        run the check, so every worker gets exactly one check'''
+    barrier.wait(timeout)
+    w3 = _worker_estimator.get_web3_client()
+    if w3.isConnected():
+        return True
+    reset_web3_client(_worker_estimator.web3_type,
+                      _worker_estimator.web3_url)
+    return _worker_estimator.get_web3_client().isConnected()
+
+
+class GasEstimationPool:
+    '''Long-lived pool of gas estimation worker processes.
+       Each worker keeps its own persistent node connection. Work is split
+       into small chunks in a shared queue, so a free worker takes the next
+       chunk and slow chunks don't hold up the rest (work stealing)'''
+    def __init__(self, web3_type: str, web3_url: str,
+                 num_workers: int = 32, chunk_size: int = 100,
+                 chunk_timeout: float = 120, batch_requests: bool = True,
+                 target_latency: float = 10):
+        self.logger = logging.getLogger('GasEstimationPool')
+        self.web3_type = web3_type
+        self.web3_url = web3_url
+        self.batch_requests = batch_requests
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.chunk_timeout = chunk_timeout
+        # Number of chunks estimated at once follows the node latency,
+        # up to num_workers
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=num_workers // 2, max_limit=num_workers,
+            target_latency=target_latency, name='GasEstimationPool')
+        self.restarts = 0
+        self._executor = None
+        # Barriers of health checks are shared with workers
+        self._manager = None
+
+    def start(self):
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_worker,
+            initargs=(self.web3_type, self.web3_url, self.batch_requests))
+
+    def shutdown(self, terminate: bool = False):
+        '''
+        Stop the workers
+        Args:
+            terminate:  Kill running workers, a hung worker never
+                        finishes its chunk otherwise
+        '''
+        if self._executor is None:
+            return
+        processes = list((self._executor._processes or {}).values())
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        if terminate:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join(5)
+
+    def restart(self):
+        self.logger.warning('Restarting gas estimation workers')
+        self.restarts += 1
+        self.shutdown(terminate=True)
+        self.start()
+
+    async def check_health(self, timeout: float = 10) -> bool:
+        ''' Ping each worker, restart the pool if they are broken
+            or stuck'''
+        event_loop = asyncio.get_event_loop()
+        if self._manager is None:
+            self._manager = Manager()
+        barrier = self._manager.Barrier(self.num_workers)
+        checks = [event_loop.run_in_executor(self._executor,
+                                             _check_worker_health,
+                                             barrier, timeout)
+                  for _ in range(self.num_workers)]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*checks),
+                                             timeout)
+            healthy = all(results)
+        except (asyncio.TimeoutError, BrokenProcessPool,
+                BrokenBarrierError) as e:
+            self.logger.error(f'Health check failed: {type(e)} {e}')
+            healthy = False
+        if not healthy:
+            self.restart()
+        return healthy
+
+    async def estimate(self, transactions: List[Dict[str, Any]],
+                       block_number: int, deadline: float = None
+                       ) -> Tuple[Dict[str, Any], List[str]]:
+        '''
+        Estimate gas for transactions
+        Args:
+            transactions:   List of transactions details from DB,
+                            chunks are estimated in this order
+            block_number:   Block number for the state
+            deadline:       Event loop time, chunks not started or
+                            not finished before it are skipped
+        Returns:
+            Dict {hash: {'block_number': block_number, 'gas': estimation}}
+            and list of hashes skipped due to the deadline. Txs of chunks
+            failed in the worker get CHUNK_ERROR estimation
+        '''
+        event_loop = asyncio.get_event_loop()
+        # The limiter keeps at most limit chunks in the executor.
+        # Chunks not started before the deadline are skipped, workers
+        # get the deadline as wall clock time and stop a started chunk
+        # at it, so the next block doesn't wait for stale chunks
+        worker_deadline = None
+        if deadline is not None:
+            worker_deadline = time.time() + deadline - event_loop.time()
+
+        async def estimate_chunk(chunk):
+            await self.limiter.acquire()
+            t1 = time.monotonic()
+            timeout = self.chunk_timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - event_loop.time())
+            if timeout <= 0:
+                await self.limiter.release(None)
+                return None
+            latency = None
+            error = False
+            try:
+                result = await asyncio.wait_for(
+                    event_loop.run_in_executor(self._executor,
+                                               _estimate_chunk_gas,
+                                               chunk, block_number,
+                                               worker_deadline),
+                    timeout)
+                latency = time.monotonic() - t1
+                return result
+            except asyncio.TimeoutError:
+                if timeout < self.chunk_timeout:
+                    # Cut by the deadline, the worker is not stuck
+                    # and the latency doesn't tell about the node
+                    return None
+                latency = time.monotonic() - t1
+                error = True
+                raise
+            except Exception:
+                latency = time.monotonic() - t1
+                error = True
+                raise
+            finally:
+                await self.limiter.release(latency, error)
+
+        chunks = list(split_on_chunks(transactions, self.chunk_size))
+        estimations = {}
+        skipped = []
+        failed = []
+        for attempt in range(2):
+            results = await asyncio.gather(
+                *[estimate_chunk(chunk) for chunk in chunks],
+                return_exceptions=True)
+            # Chunks lost with broken or hung workers are retried once
+            # after the pool restart
+            lost_chunks = []
+            for chunk, result in zip(chunks, results):
+                if result is None:
+                    skipped.extend(tx['hash'] for tx in chunk)
+                elif isinstance(result, (BrokenProcessPool,
+                                         asyncio.TimeoutError)):
+                    lost_chunks.append(chunk)
+                elif isinstance(result, BaseException):
+                    self.logger.error((f'Chunk failed: {type(result)} '
+                                       f'{result}'))
+                    failed.extend(chunk)
+                else:
+                    estimations.update(result)
+                    # Stopped by the deadline in the worker
+                    skipped.extend(tx['hash'] for tx in chunk
+                                   if tx['hash'] not in result)
+            if not lost_chunks:
+                break
+            self.logger.error((f'{len(lost_chunks)} chunks lost '
+                               f'(attempt {attempt + 1})'))
+            self.restart()
+            chunks = lost_chunks
+        else:
+            failed.extend(tx for chunk in lost_chunks for tx in chunk)
+        for tx in failed:
+            estimations[tx['hash']] = {'block_number': block_number,
+                                       'gas': CHUNK_ERROR}
+        return estimations, skipped
+
+
+def get_effective_priority_fee(tx: Dict[str, Any], base_fee: int) -> int:
+    ''' Priority fee per gas the tx pays to the validator at base fee'''
+    if tx.get('maxFeePerGas') is not None:
+        return min(tx.get('maxPriorityFeePerGas', tx['maxFeePerGas']),
+                   tx['maxFeePerGas'] - base_fee)
+    return tx['gasPrice'] - base_fee
+
+
+def sort_by_priority_fee(transactions: List[Dict[str, Any]],
+                         base_fee: int) -> List[Dict[str, Any]]:
+    ''' Transactions ordered as a validator would include them:
+        the highest effective priority fee first'''
+    return sorted(transactions,
+                  key=lambda tx: get_effective_priority_fee(tx, base_fee),
+                  reverse=True)
+
+
+class GasEstimateCache:
+    '''Gas estimations reused between blocks.
+       An estimation is kept in tx_estimated_gas document of the tx
+       (field 'cache') together with the sender nonce and balance bucket
+       it was made for. It is reused while the sender state is the same:
+       successful estimations for max_age blocks, failed ones until
+       the retry block, retry interval grows exponentially with
+       the number of failures in a row. Failures not caused by the
+       sender or contracts state (UNCACHED_RESULTS) are not cached'''
+    def __init__(self, collection: Collection,
+                 max_age: int = 32,
+                 balance_precision: float = 0.1,
+                 backoff_base: int = 1,
+                 max_backoff: int = 64):
+        self.collection = collection
+        # Successful estimation is refreshed after max_age blocks anyway:
+        # state of called contracts may change
+        self.max_age = max_age
+        # Relative width of balance buckets
+        self.balance_precision = balance_precision
+        # Failed txs are retried after backoff_base * 2 ** (failures - 1)
+        # blocks, but not later than max_backoff blocks
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_balance_bucket(self, eth: float) -> Optional[int]:
+        if eth <= 0:
+            return None
+        return math.floor(math.log(eth) / math.log1p(self.balance_precision))
+
+    def get_key(self, state: Optional[Dict[str, Any]]
+                ) -> Optional[Dict[str, Any]]:
+        ''' Sender state key of estimation, None if state is unknown'''
+        if state is None:
+            return None
+        return {'nonce': state['n_txs'],
+                'balance_bucket': self.get_balance_bucket(state['eth'])}
+
+    def is_valid(self, entry: Dict[str, Any], key: Dict[str, Any],
+                 block_number: int) -> bool:
+        if (entry['nonce'] != key['nonce']
+                or entry['balance_bucket'] != key['balance_bucket']):
+            return False
+        if isinstance(entry['gas'], int):
+            return block_number - entry['block'] < self.max_age
+        return block_number < entry['retry_block']
+
+    def split(self, transactions: List[Dict[str, Any]],
+              states: Dict[str, Dict[str, Any]],
+              block_number: int
+              ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        '''
+        Split transactions on cached estimations and txs to estimate
+        Args:
+            transactions:   List of transactions details
+            states:         Senders states {address: {'n_txs', 'eth'}}
+            block_number:   Block number of the state for estimation
+        Returns:
+            Dict {hash: {'block_number': block_number, 'gas': estimation}}
+            of cached estimations and list of txs to estimate
+        '''
+        hashes = [tx['hash'] for tx in transactions]
+        docs = self.collection.find({'hash': {'$in': hashes},
+                                     'cache': {'$exists': True}},
+                                    {'_id': 0, 'hash': 1, 'cache': 1})
+        self._entries = {d['hash']: d['cache'] for d in docs}
+        cached = {}
+        to_estimate = []
+        for tx in transactions:
+            entry = self._entries.get(tx['hash'])
+            key = self.get_key(states.get(tx['from']))
+            if (entry is not None and key is not None
+                    and self.is_valid(entry, key, block_number)):
+                cached[tx['hash']] = {'block_number': block_number,
+                                      'gas': entry['gas']}
+            else:
+                to_estimate.append(tx)
+        self.hits += len(cached)
+        self.misses += len(to_estimate)
+        return cached, to_estimate
+
+    def make_entries(self, transactions: List[Dict[str, Any]],
+                     estimations: Dict[str, Any],
+                     states: Dict[str, Dict[str, Any]],
+                     block_number: int) -> Dict[str, Dict[str, Any]]:
+        '''
+        Cache entries of new estimations, split has to be called
+        for the same block first
+        Args:
+            transactions:   Estimated transactions details
+            estimations:    Result of GasEstimationPool.estimate
+            states:         Senders states {address: {'n_txs', 'eth'}}
+            block_number:   Block number of the state for estimation
+        Returns:
+            Dict {hash: entry} to save into 'cache' field
+        '''
+        entries = {}
+        for tx in transactions:
+            if tx['hash'] not in estimations:
+                continue
+            key = self.get_key(states.get(tx['from']))
+            if key is None:
+                continue
+            gas = estimations[tx['hash']]['gas']
+            if gas in UNCACHED_RESULTS:
+                continue
+            entry = dict(key, block=block_number, gas=gas,
+                         failures=0, retry_block=None)
+            if not isinstance(gas, int):
+                previous = self._entries.get(tx['hash'])
+                if (previous is not None
+                        and not isinstance(previous['gas'], int)
+                        and previous['nonce'] == key['nonce']
+                        and previous['balance_bucket']
+                        == key['balance_bucket']):
+                    entry['failures'] = previous['failures'] + 1
+                else:
+                    entry['failures'] = 1
+                backoff = self.backoff_base * 2 ** (entry['failures'] - 1)
+                entry['retry_block'] = block_number + min(backoff,
+                                                          self.max_backoff)
+            entries[tx['hash']] = entry
+        return entries
+
+
+class PlainTransferClassifier:
+    '''Resolves gas of plain ETH transfers without the node:
+       a tx with empty input, without access list and with recipient
+       that has no code always uses 21000 gas if the sender can pay
+       for it. Code presence of recipients is cached, accounts without
+       code are rechecked after max_age blocks (code can be deployed
+       to an address)'''
+    def __init__(self, max_size: int = 1_000_000, max_age: int = 7200,
+                 batch_size: int = 1000):
+        self.max_size = max_size
+        self.max_age = max_age
+        # Max number of getCode calls in one JSON-RPC batch
+        self.batch_size = batch_size
+        self._has_code = OrderedDict()
+        self.skipped = 0
+
+    def is_candidate(self, tx: Dict[str, Any]) -> bool:
+        ''' Transaction looks like a plain transfer, recipient
+            code is not checked'''
+        if tx.get('to') is None:
+            return False
+        if tx.get('input') not in (None, '', '0x', b''):
+            return False
+        if tx.get('accessList') or tx.get('authorizationList'):
+            return False
+        return int(tx['to'], 16) > MAX_PRECOMPILE_ADDRESS
+
+    def is_affordable(self, tx: Dict[str, Any],
+                      state: Optional[Dict[str, Any]]) -> bool:
+        ''' Sender balance covers value and 21000 gas at the max fee,
+            False if the sender state is unknown'''
+        if state is None:
+            return False
+        fee = tx.get('maxFeePerGas') or tx.get('gasPrice') or 0
+        cost = int(tx.get('value') or 0) + PLAIN_TRANSFER_GAS * fee
+        return cost / 10 ** 18 < state['eth']
+
+    def update_code_cache(self, addresses: List[str], w3: Web3,
+                          block_number: int):
+        unknown = []
+        for address in set(addresses):
+            entry = self._has_code.get(address)
+            if entry is None or (not entry[1]
+                                 and block_number - entry[0] >= self.max_age):
+                unknown.append(address)
+        fetched = get_code_presence_batch(w3, unknown, block_number,
+                                          self.batch_size)
+        for address, has_code in fetched.items():
+            self._has_code[address] = (block_number, has_code)
+            self._has_code.move_to_end(address)
+        while len(self._has_code) > self.max_size:
+            self._has_code.popitem(last=False)
+
+    def split(self, transactions: List[Dict[str, Any]], w3: Web3,
+              block_number: int, states: Dict[str, Dict[str, Any]]
+              ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        '''
+        Split transactions on plain transfers and txs to estimate
+        Args:
+            transactions:   List of transactions details
+            w3:             Web3 client
+            block_number:   Block number of the state for estimation
+            states:         Senders states {address: {'n_txs', 'eth'}},
+                            transfers the sender can't pay for go to
+                            the node to get its error
+        Returns:
+            Dict {hash: {'block_number': block_number, 'gas': 21000}}
+            for plain transfers and list of other txs
+        '''
+        candidates = [tx for tx in transactions if self.is_candidate(tx)
+                      and self.is_affordable(tx, states.get(tx['from']))]
+        self.update_code_cache([tx['to'] for tx in candidates], w3,
+                               block_number)
+        estimations = {}
+        to_estimate = []
+        for tx in transactions:
+            entry = self._has_code.get(tx.get('to'))
+            if (entry is not None and not entry[1]
+                    and self.is_candidate(tx)
+                    and self.is_affordable(tx, states.get(tx['from']))):
+                estimations[tx['hash']] = {'block_number': block_number,
+                                           'gas': PLAIN_TRANSFER_GAS}
+            else:
+                to_estimate.append(tx)
+        self.skipped += len(estimations)
+        return estimations, to_estimate
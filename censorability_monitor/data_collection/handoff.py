@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from queue import Empty, Full
+from typing import Any
+
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+
+def change_streams_available(collection: Collection) -> bool:
+    ''' MongoDB supports change streams (replica set or sharded)'''
+    try:
+        collection.watch(max_await_time_ms=1).close()
+        return True
+    except PyMongoError:
+        return False
+
+
+def notify_block(queue: Any, block_number: int):
+    ''' Put the block into a bounded queue of the downstream stage,
+        a full queue already has wake ups for it'''
+    try:
+        queue.put_nowait(block_number)
+    except Full:
+        pass
+
+
+class BlockEvents:
+    '''Wakes up a stage when the upstream stage has saved a block.
+       Listens to updates of the upstream stage checkpoint with a change
+       stream if MongoDB supports it (replica set). Otherwise waits on
+       a queue filled by the upstream stage running on the same host,
+       or just sleeps if there is no queue. A wake up only means that
+       a new block may be ready: the stage reads the checkpoint itself'''
+    def __init__(self, collection: Collection, stage: str,
+                 queue: Any = None, name: str = 'BlockEvents'):
+        # stage_checkpoints collection
+        self.collection = collection
+        # Upstream stage
+        self.stage = stage
+        # Queue (multiprocessing.Manager().Queue()) with block numbers
+        self.queue = queue
+        self.name = name
+        self.mode = None
+        self._stream = None
+
+    def open(self):
+        logger = logging.getLogger(self.name)
+        try:
+            self._stream = self.collection.watch(
+                [{'$match': {'operationType': {'$in': ['insert', 'update',
+                                                       'replace']},
+                             'documentKey._id': self.stage}}],
+                max_await_time_ms=500)
+            self.mode = 'change_stream'
+        except PyMongoError as e:
+            logger.info(f'Change streams are not available: {e}')
+            self.mode = 'queue' if self.queue is not None else 'poll'
+        logger.info(f'Waiting for {self.stage} using {self.mode}')
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self.mode = None
+
+    async def wait(self, timeout: float) -> bool:
+        '''
+        Wait until the upstream stage saves a block
+        Args:
+            timeout:    Max seconds to wait
+        Returns:
+            True if notified, False on timeout
+        '''
+        if self.mode is None:
+            self.open()
+        if timeout <= 0:
+            return False
+        event_loop = asyncio.get_event_loop()
+        if self.mode == 'change_stream':
+            return await event_loop.run_in_executor(
+                None, self._wait_change, timeout)
+        if self.mode == 'queue':
+            return await event_loop.run_in_executor(
+                None, self._wait_queue, timeout)
+        await asyncio.sleep(timeout)
+        return False
+
+    def _wait_change(self, timeout: float) -> bool:
+        logger = logging.getLogger(self.name)
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline:
+                if self._stream.try_next() is not None:
+                    return True
+        except PyMongoError as e:
+            # Reopen the stream on the next wait
+            logger.warning(f'Change stream error: {type(e)} {e}')
+            self.close()
+        return False
+
+    def _wait_queue(self, timeout: float) -> bool:
+        try:
+            self.queue.get(timeout=timeout)
+        except Empty:
+            return False
+        # Several blocks can be saved while the stage was busy
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                return True
@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional
+
+METRICS_PREFIX = 'censorability_collector'
+# Metrics ending with _total are counters, the rest are gauges
+METRICS_HELP = {
+    'up': 'Collector process is running',
+    'restarts_total': 'Collector restarts by the supervisor',
+    'iteration_seconds': 'Duration of the last collector loop iteration',
+    'iterations_total': 'Collector loop iterations',
+    'overruns_total': 'Loop iterations longer than the collector interval',
+    'items_total': ('Processed items: txs for MempoolCollector, '
+                    'blocks for the other collectors'),
+    'items_per_second': 'Processed items per second, last minute',
+    'lag_blocks': 'Blocks behind the chain head',
+    'last_iteration_timestamp_seconds': ('Time of the last loop iteration '
+                                         'or heartbeat'),
+    'write_queue_depth': 'Operations queued in the write-behind writer',
+    'rpc_concurrency_limit': 'Adaptive limit of in-flight node requests',
+    'rpc_latency_p50_seconds': 'Node request latency, median',
+    'rpc_latency_p99_seconds': 'Node request latency, 99th percentile',
+}
+
+
+class CollectorMetrics:
+    '''Loop metrics of one collector. Items per second are counted
+       over the last rate_window seconds'''
+    def __init__(self, interval: float, rate_window: float = 60):
+        self.interval = interval
+        self.rate_window = rate_window
+        self.iteration_seconds = 0.0
+        self.iterations = 0
+        self.overruns = 0
+        self.items = 0
+        self.lag_blocks = None
+        self.last_iteration_ts = time.time()
+        self._items_window = deque()
+
+    def iteration(self, duration: float, items: int = 0,
+                  lag_blocks: Optional[int] = None):
+        '''
+        Record a loop iteration
+        Args:
+            duration:   Seconds the iteration took
+            items:      Number of items processed
+            lag_blocks: Blocks behind the chain head, None - not tracked
+        '''
+        now = time.time()
+        self.iteration_seconds = duration
+        self.iterations += 1
+        if duration > self.interval:
+            self.overruns += 1
+        self.items += items
+        if lag_blocks is not None:
+            self.lag_blocks = lag_blocks
+        self.last_iteration_ts = now
+        self._items_window.append((now, items))
+        while self._items_window[0][0] < now - self.rate_window:
+            self._items_window.popleft()
+
+    def heartbeat(self):
+        ''' Collector is alive in a long or waiting iteration'''
+        self.last_iteration_ts = time.time()
+
+    def get_items_per_second(self) -> float:
+        if len(self._items_window) == 0:
+            return 0.0
+        period = max(time.time() - self._items_window[0][0],
+                     self.iteration_seconds, self.interval)
+        return sum(n for _, n in self._items_window) / period
+
+    def to_dict(self) -> Dict[str, Any]:
+        metrics = {'iteration_seconds': self.iteration_seconds,
+                   'iterations_total': self.iterations,
+                   'overruns_total': self.overruns,
+                   'items_total': self.items,
+                   'items_per_second': self.get_items_per_second(),
+                   'last_iteration_timestamp_seconds':
+                       self.last_iteration_ts}
+        if self.lag_blocks is not None:
+            metrics['lag_blocks'] = self.lag_blocks
+        return metrics
+
+
+def get_limiter_metrics(limiter_metrics: Dict[str, Any]) -> Dict[str, Any]:
+    ''' Exported metrics of AdaptiveConcurrencyLimiter.metrics()'''
+    return {'rpc_concurrency_limit': limiter_metrics['limit'],
+            'rpc_latency_p50_seconds': limiter_metrics['latency_p50'],
+            'rpc_latency_p99_seconds': limiter_metrics['latency_p99']}
+
+
+def format_metrics(collectors_metrics: Dict[str, Dict[str, Any]]) -> str:
+    '''
+    Prometheus text exposition format
+    Args:
+        collectors_metrics: Dict {collector: {metric: value}}
+    Returns:
+        Text with one family per metric, collectors are labels
+    '''
+    families = {}
+    for collector, metrics in sorted(collectors_metrics.items()):
+        for metric, value in metrics.items():
+            if value is None:
+                continue
+            families.setdefault(metric, []).append(
+                f'{METRICS_PREFIX}_{metric}{{collector="{collector}"}} '
+                f'{float(value)}')
+    lines = []
+    for metric, samples in sorted(families.items()):
+        metric_type = 'counter' if metric.endswith('_total') else 'gauge'
+        lines.append(f'# HELP {METRICS_PREFIX}_{metric} '
+                     f'{METRICS_HELP.get(metric, metric)}')
+        lines.append(f'# TYPE {METRICS_PREFIX}_{metric} {metric_type}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    '''Local HTTP endpoint with metrics in Prometheus text format,
+       served from a background thread'''
+    def __init__(self, get_metrics: Callable[[], Dict[str, Dict[str, Any]]],
+                 host: str = '127.0.0.1', port: int = 9108):
+        self.get_metrics = get_metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        logger = logging.getLogger('MetricsServer')
+        get_metrics = self.get_metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = format_metrics(get_metrics()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=self._server.serve_forever,
+                         name='MetricsServer', daemon=True).start()
+        logger.info(f'Metrics at http://{self.host}:{self.port}/metrics')
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
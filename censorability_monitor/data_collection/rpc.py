@@ -0,0 +1,238 @@
+import asyncio
+import json
+import socket
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from web3._utils.method_formatters import transaction_result_formatter
+from web3._utils.request import make_post_request
+from web3._utils.threads import Timeout
+from web3.auto import Web3
+from web3.datastructures import AttributeDict
+from web3.providers import HTTPProvider, IPCProvider, WebsocketProvider
+
+from censorability_monitor.data_collection.utils import split_on_chunks
+
+# Node errors meaning that the state of the block is pruned
+MISSING_STATE_ERRORS = ['missing trie node', 'historical state',
+                        'state is not available', 'state not available']
+
+
+class MissingStateError(Exception):
+    '''The node doesn't keep the state of the requested block'''
+
+
+def is_missing_state_error(error: Any) -> bool:
+    ''' Error object or exception means that the block state is pruned'''
+    if isinstance(error, dict):
+        error = error.get('message', error)
+    message = str(error).lower()
+    return any(e in message for e in MISSING_STATE_ERRORS)
+
+
+def make_batch_request(w3: Web3,
+                       calls: Sequence[Tuple[str, List[Any]]]
+                       ) -> List[Dict[str, Any]]:
+    '''
+    Send several JSON-RPC calls to the node as one batch request
+    Args:
+        w3:     Web3 client with ipc, http or websocket provider
+        calls:  List of (method, params) pairs
+    Returns:
+        List of raw JSON-RPC responses in the same order as calls,
+        raises ValueError if the node rejected the whole batch
+    '''
+    if len(calls) == 0:
+        return []
+    payload = [{'jsonrpc': '2.0', 'method': method,
+                'params': params, 'id': i}
+               for i, (method, params) in enumerate(calls)]
+    request_data = json.dumps(payload).encode('utf-8')
+
+    provider = w3.provider
+    if isinstance(provider, IPCProvider):
+        responses = _send_ipc_batch(provider, request_data)
+    elif isinstance(provider, HTTPProvider):
+        raw_response = make_post_request(
+            provider.endpoint_uri, request_data,
+            **dict(provider.get_request_kwargs()))
+        responses = json.loads(raw_response)
+    elif isinstance(provider, WebsocketProvider):
+        future = asyncio.run_coroutine_threadsafe(
+            provider.coro_make_request(request_data),
+            WebsocketProvider._loop)
+        responses = future.result()
+    else:
+        raise Exception(f'Batch requests are not supported by {provider}')
+
+    return match_batch_responses(len(calls), responses)
+
+
+def match_batch_responses(n_calls: int, responses: Any
+                          ) -> List[Dict[str, Any]]:
+    '''
+    Match batch responses to calls by id, calls are numbered from 0
+    Returns:
+        List of responses in the same order as calls, calls without
+        a response get an error response
+    '''
+    # The node answers with a single error object if the whole batch failed
+    if isinstance(responses, dict):
+        raise ValueError(responses.get('error', responses))
+    by_id = {r.get('id'): r for r in responses}
+    return [by_id.get(i, {'id': i, 'error': {'code': -32603,
+                                             'message': 'no response'}})
+            for i in range(n_calls)]
+
+
+def _send_ipc_batch(provider: IPCProvider, request_data: bytes) -> List[Any]:
+    ''' Send raw batch over the provider's persistent IPC socket'''
+    with provider._lock, provider._socket as sock:
+        try:
+            sock.sendall(request_data)
+        except BrokenPipeError:
+            # one extra attempt, then give up
+            sock = provider._socket.reset()
+            sock.sendall(request_data)
+
+        raw_response = b''
+        with Timeout(provider.timeout) as timeout:
+            while True:
+                try:
+                    raw_response += sock.recv(65536)
+                except socket.timeout:
+                    timeout.sleep(0)
+                    continue
+                if not raw_response.rstrip().endswith((b']', b'}')):
+                    timeout.sleep(0)
+                    continue
+                try:
+                    return json.loads(raw_response)
+                except json.JSONDecodeError:
+                    timeout.sleep(0)
+                    continue
+
+
+def get_transactions_batch(w3: Web3, hashes: List[str],
+                           batch_size: int = 1000
+                           ) -> Dict[str, Optional[AttributeDict]]:
+    '''
+    Get transactions by hashes using JSON-RPC batch requests
+    Args:
+        w3:         Web3 client
+        hashes:     List of transaction hashes
+        batch_size: Max number of calls in one batch request
+    Returns:
+        Dict {hash: transaction}, transaction is formatted the same way
+        as w3.eth.getTransaction does, or None if it was not found
+        or the node rejected the batch
+    '''
+    transactions = {}
+    for batch in split_on_chunks(list(hashes), batch_size):
+        try:
+            responses = make_batch_request(
+                w3, [('eth_getTransactionByHash', [h]) for h in batch])
+        except ValueError:
+            transactions.update((tx_hash, None) for tx_hash in batch)
+            continue
+        for tx_hash, response in zip(batch, responses):
+            result = response.get('result')
+            if 'error' in response or result is None:
+                transactions[tx_hash] = None
+                continue
+            transactions[tx_hash] = AttributeDict.recursive(
+                transaction_result_formatter(result))
+    return transactions
+
+
+def get_account_calls(addresses: List[str],
+                      block_number: int) -> List[Tuple[str, List[Any]]]:
+    ''' Nonce and balance calls for each address, two per address'''
+    block = hex(block_number)
+    calls = []
+    for address in addresses:
+        calls.append(('eth_getTransactionCount', [address, block]))
+        calls.append(('eth_getBalance', [address, block]))
+    return calls
+
+
+def parse_account_responses(addresses: List[str],
+                            responses: List[Dict[str, Any]]
+                            ) -> Dict[str, Dict[str, Any]]:
+    '''
+    Parse responses of get_account_calls batch
+    Returns:
+        Dict {address: {'n_txs': nonce, 'eth': balance in ETH}},
+        addresses with failed calls are skipped
+    Raises:
+        MissingStateError if the node doesn't keep the block state
+    '''
+    result = {}
+    for i, address in enumerate(addresses):
+        n_txs_response = responses[2 * i]
+        balance_response = responses[2 * i + 1]
+        for response in (n_txs_response, balance_response):
+            if is_missing_state_error(response.get('error', '')):
+                raise MissingStateError(response['error'])
+        if 'error' in n_txs_response or 'error' in balance_response:
+            continue
+        result[address] = {
+            'n_txs': int(n_txs_response['result'], 16),
+            'eth': int(balance_response['result'], 16) / 10 ** 18}
+    return result
+
+
+def get_accounts_data_batch(w3: Web3, addresses: List[str],
+                            block_number: int, batch_size: int = 100
+                            ) -> Dict[str, Dict[str, Any]]:
+    '''
+    Get nonce and balance of accounts using JSON-RPC batch requests
+    Args:
+        w3:             Web3 client
+        addresses:      List of accounts
+        block_number:   Block number for the state
+        batch_size:     Number of accounts in one batch request
+    Returns:
+        Dict {address: {'n_txs': nonce, 'eth': balance in ETH}},
+        accounts of batches rejected by the node are skipped
+    Raises:
+        MissingStateError if the node doesn't keep the block state
+    '''
+    result = {}
+    for batch in split_on_chunks(list(addresses), batch_size):
+        try:
+            responses = make_batch_request(
+                w3, get_account_calls(batch, block_number))
+        except ValueError as e:
+            if is_missing_state_error(e):
+                raise MissingStateError(e)
+            continue
+        result.update(parse_account_responses(batch, responses))
+    return result
+
+
+def get_code_presence_batch(w3: Web3, addresses: List[str],
+                            block_number: int, batch_size: int = 1000
+                            ) -> Dict[str, bool]:
+    '''
+    Check which accounts have code using JSON-RPC batch requests
+    Args:
+        w3:             Web3 client
+        addresses:      List of accounts
+        block_number:   Block number for the state
+        batch_size:     Max number of calls in one batch request
+    Returns:
+        Dict {address: has code}, addresses with failed calls are skipped
+    '''
+    block = hex(block_number)
+    result = {}
+    for batch in split_on_chunks(list(addresses), batch_size):
+        try:
+            responses = make_batch_request(
+                w3, [('eth_getCode', [a, block]) for a in batch])
+        except ValueError:
+            continue
+        for address, response in zip(batch, responses):
+            if 'error' in response:
+                continue
+            result[address] = response['result'] not in ('0x', '')
+    return result
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+import websockets
+from web3._utils.method_formatters import transaction_result_formatter
+from web3.datastructures import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+
+class PendingTransactionsSubscription:
+    '''Push based stream of pending transactions.
+       Subscribes to newPendingTransactions with full transaction
+       objects over IPC or WebSocket connection'''
+    def __init__(self, web3_type: str, web3_url: str):
+        self.web3_type = web3_type
+        self.web3_url = web3_url
+        self.subscription_id = None
+        self._reader = None
+        self._writer = None
+        self._ws = None
+
+    async def __aenter__(self):
+        if self.web3_type == 'ipc':
+            self._reader, self._writer = await asyncio.open_unix_connection(
+                self.web3_url, limit=2 ** 24)
+        elif self.web3_type == 'ws':
+            self._ws = await websockets.connect(self.web3_url, max_size=None)
+        else:
+            raise Exception(('Subscription is not supported for '
+                             f'web3 connection type: {self.web3_type}'))
+        await self._send({'jsonrpc': '2.0', 'id': 1,
+                          'method': 'eth_subscribe',
+                          'params': ['newPendingTransactions', True]})
+        response = await self._read()
+        if 'error' in response:
+            raise ValueError(response['error'])
+        self.subscription_id = response['result']
+        logger.info(f'Subscribed to pending txs: {self.subscription_id}')
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._writer is not None:
+            self._writer.close()
+        if self._ws is not None:
+            await self._ws.close()
+
+    async def _send(self, message: Dict[str, Any]):
+        data = json.dumps(message)
+        if self._ws is not None:
+            await self._ws.send(data)
+        else:
+            self._writer.write(data.encode('utf-8') + b'\n')
+            await self._writer.drain()
+
+    async def _read(self) -> Dict[str, Any]:
+        if self._ws is not None:
+            return json.loads(await self._ws.recv())
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError('IPC connection closed by the node')
+        return json.loads(line)
+
+    async def receive(self, duration: float
+                      ) -> List[Tuple[int, Union[str, AttributeDict]]]:
+        '''
+        Collect notifications received during the given time
+        Args:
+            duration:   Seconds to wait for notifications
+        Returns:
+            List of (first seen timestamp, transaction) pairs. Transaction
+            is formatted as w3.eth.getTransaction result or is a hash
+            string if the node doesn't send full transaction objects
+        '''
+        event_loop = asyncio.get_event_loop()
+        deadline = event_loop.time() + duration
+        transactions = []
+        while True:
+            time_left = deadline - event_loop.time()
+            if time_left <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(self._read(), time_left)
+            except asyncio.TimeoutError:
+                break
+            if message.get('method') != 'eth_subscription':
+                continue
+            result = message['params']['result']
+            if isinstance(result, dict):
+                result = AttributeDict.recursive(
+                    transaction_result_formatter(result))
+            transactions.append((int(time.time()), result))
+        return transactions
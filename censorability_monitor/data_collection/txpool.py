@@ -0,0 +1,123 @@
+import logging
+import time
+from typing import Iterable, List, Set
+
+from web3.auto import Web3
+
+from censorability_monitor.data_collection.rpc import get_transactions_batch
+
+
+class TxPoolTracker:
+    '''In-memory set of transactions hashes in the node's txpool.
+       The set is built once from txpool_content and then kept up to date
+       incrementally: new hashes come from a pending transactions filter,
+       hashes included in blocks are removed. Evicted and replaced txs are
+       not reported by the node, so the set is compared with txpool_status
+       counters each block and rebuilt when it drifts too far or the
+       resync interval has passed'''
+    def __init__(self, resync_interval: float = 600,
+                 max_drift: float = 0.05, batch_size: int = 1000,
+                 name: str = 'TxPoolTracker'):
+        self.resync_interval = resync_interval
+        # Max relative difference between tracked and node pool sizes
+        self.max_drift = max_drift
+        # Max number of getTransaction calls in one JSON-RPC batch
+        self.batch_size = batch_size
+        self.name = name
+        self._hashes = set()
+        self._filter = None
+        self.last_resync = None
+        self.resyncs = 0
+
+    def __contains__(self, tx_hash: str) -> bool:
+        return tx_hash in self._hashes
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def resync(self, w3: Web3):
+        ''' Rebuild the set from the full txpool content'''
+        logger = logging.getLogger(self.name)
+        t1 = time.time()
+        # New pending filter first: txs arriving during txpool_content
+        # call are picked up by the next update
+        self._filter = w3.eth.filter('pending')
+        hashes = get_pool_hashes(w3.geth.txpool.content())
+        self._hashes = hashes
+        self.last_resync = time.time()
+        self.resyncs += 1
+        logger.info((f'Txpool resync: {len(hashes)} txs, '
+                     f'took {time.time() - t1:0.2f} s'))
+
+    def update(self, w3: Web3, included: Iterable[str] = ()):
+        '''
+        Apply pool changes since the previous update
+        Args:
+            w3:         Web3 client
+            included:   Hashes of txs included in new blocks
+        '''
+        logger = logging.getLogger(self.name)
+        if (self._filter is None or self.last_resync is None
+                or time.time() - self.last_resync > self.resync_interval):
+            self.resync(w3)
+            return
+        try:
+            new_hashes = self._filter.get_new_entries()
+        except Exception as e:
+            # Node removes filters that are not polled for a while
+            logger.warning(f'Pending filter is lost: {type(e)} {e}')
+            self.resync(w3)
+            return
+        self._hashes.update(h.hex() for h in new_hashes)
+        self._hashes.difference_update(included)
+
+        node_size = get_txpool_size(w3)
+        drift = abs(len(self._hashes) - node_size) / max(node_size, 1)
+        if drift > self.max_drift:
+            logger.info((f'Txpool drift {drift:0.1%}: tracked '
+                         f'{len(self._hashes)}, node {node_size}'))
+            self.resync(w3)
+
+    def find_dropped(self, w3: Web3, hashes: Iterable[str]) -> List[str]:
+        '''
+        Find transactions that are not in the pool anymore
+        Args:
+            w3:     Web3 client
+            hashes: Candidate transactions hashes
+        Returns:
+            List of hashes of dropped transactions
+        '''
+        missing = [h for h in hashes if h not in self._hashes]
+        if len(missing) == 0:
+            return []
+        # Queued txs are not reported by the pending filter until they
+        # are promoted, so the node confirms misses before dropping
+        transactions = get_transactions_batch(w3, missing, self.batch_size)
+        dropped = []
+        for tx_hash in missing:
+            tx = transactions[tx_hash]
+            if tx is not None and tx['blockNumber'] is None:
+                self._hashes.add(tx_hash)
+            else:
+                dropped.append(tx_hash)
+        return dropped
+
+
+def get_txpool_size(w3: Web3) -> int:
+    ''' Number of pending and queued txs reported by txpool_status'''
+    status = w3.geth.txpool.status()
+    size = 0
+    for pool in ('pending', 'queued'):
+        value = status[pool]
+        size += int(value, 16) if isinstance(value, str) else value
+    return size
+
+
+def get_pool_hashes(content) -> Set[str]:
+    ''' Hashes of all txs in txpool_content result'''
+    hashes = set()
+    for pool in ('pending', 'queued'):
+        for _, txs in content[pool].items():
+            for _, tx in txs.items():
+                hashes.add(tx['hash'])
+    return hashes
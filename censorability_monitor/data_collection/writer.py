@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Callable, Dict, List
+
+from pymongo import InsertOne, MongoClient
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+class WriteBehindWriter:
+    '''Asynchronous write-behind sink for MongoDB.
+       Collectors queue write operations without waiting for the database,
+       a background thread coalesces them into unordered bulk writes.
+       Operations are written in the order of submission, consecutive
+       operations on the same collection go into one bulk write'''
+    def __init__(self, mongo_url: str, db_name: str,
+                 batch_size: int = 5000,
+                 flush_interval: float = 0.5,
+                 max_queue_size: int = 500_000,
+                 max_retries: int = 3,
+                 name: str = 'WriteBehindWriter'):
+        self.mongo_url = mongo_url
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.name = name
+        self._queue = deque()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        # Set by after_written: write without waiting for flush_interval
+        self._flush_requested = False
+        # Metrics
+        self.max_queue_depth = 0
+        self.ops_written = 0
+        self.write_errors = 0
+        self.bulk_writes = 0
+        self.throttled = 0
+        self.last_flush_duration = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: float = None):
+        ''' Write all queued operations and stop the writer thread'''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue) + self._in_flight
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'ops_written': self.ops_written,
+                'bulk_writes': self.bulk_writes,
+                'write_errors': self.write_errors,
+                'throttled': self.throttled,
+                'last_flush_duration': self.last_flush_duration}
+
+    def submit(self, collection: str, operations: List[Any]):
+        '''
+        Queue write operations, never waits for the database
+        Args:
+            collection: Collection name
+            operations: List of pymongo write models
+                        (InsertOne, UpdateOne, UpdateMany, ...)
+        '''
+        if len(operations) == 0:
+            return
+        with self._condition:
+            self._queue.extend((collection, op) for op in operations)
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       self.queue_depth)
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify_all()
+
+    def insert_many(self, collection: str, documents: List[Dict[str, Any]]):
+        self.submit(collection, [InsertOne(d) for d in documents])
+
+    def after_written(self, callback: Callable[[], Any]):
+        ''' Call the callback from the writer thread once all operations
+            queued before it are written'''
+        with self._condition:
+            self._queue.append((None, callback))
+            self._flush_requested = True
+            self._condition.notify_all()
+
+    async def throttle(self):
+        ''' Backpressure: pause the caller while the queue is overfilled'''
+        logger = logging.getLogger(self.name)
+        if self.queue_depth <= self.max_queue_size:
+            return
+        self.throttled += 1
+        logger.warning((f'Write queue is full: {self.queue_depth} ops, '
+                        'waiting for the database'))
+        while self.queue_depth > self.max_queue_size:
+            await asyncio.sleep(self.flush_interval)
+
+    def flush(self, timeout: float = None) -> bool:
+        ''' Block until all queued operations are written'''
+        with self._condition:
+            self._condition.notify_all()
+            return self._condition.wait_for(
+                lambda: self.queue_depth == 0, timeout)
+
+    def _run(self):
+        db = MongoClient(self.mongo_url)[self.db_name]
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: (len(self._queue) >= self.batch_size
+                             or self._flush_requested or self._closed),
+                    self.flush_interval)
+                self._flush_requested = False
+                n = min(len(self._queue), self.batch_size)
+                batch = [self._queue.popleft() for _ in range(n)]
+                self._in_flight = n
+            if batch:
+                self._write(db, batch)
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()
+                if self._closed and not self._queue:
+                    return
+
+    def _write(self, db, batch: List[Any]):
+        logger = logging.getLogger(self.name)
+        t1 = time.time()
+        for collection, ops in groupby(batch, key=itemgetter(0)):
+            requests = [op for _, op in ops]
+            if collection is None:
+                self._run_callbacks(requests)
+                continue
+            for attempt in range(self.max_retries + 1):
+                try:
+                    db[collection].bulk_write(requests, ordered=False)
+                    self.ops_written += len(requests)
+                    break
+                except BulkWriteError as bwe:
+                    # Duplicates are expected - ignore them
+                    errors = [e for e in bwe.details['writeErrors']
+                              if e['code'] != 11000]
+                    self.ops_written += len(requests) - len(errors)
+                    if errors:
+                        self.write_errors += len(errors)
+                        logger.error((f'{collection}: {len(errors)} write '
+                                      f'errors, first: {errors[0]}'))
+                    break
+                except PyMongoError as e:
+                    if attempt == self.max_retries:
+                        self.write_errors += len(requests)
+                        logger.error((f'{collection}: lost {len(requests)} '
+                                      f'ops: {type(e)} {e}'))
+                        break
+                    time.sleep(self.flush_interval * 2 ** attempt)
+            self.bulk_writes += 1
+        self.last_flush_duration = time.time() - t1
+
+    def _run_callbacks(self, callbacks: List[Callable[[], Any]]):
+        logger = logging.getLogger(self.name)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f'Callback failed: {type(e)} {e}')
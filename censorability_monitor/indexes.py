@@ -0,0 +1,146 @@
+import logging
+from typing import Any, Dict, List, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.database import Database
+
+logger = logging.getLogger(__name__)
+
+# Indexes of each database: {collection: [(keys, options), ...]}.
+# They are created once on start, code working with collections
+# doesn't call create_index
+COLLECTOR_INDEXES = {
+    'tx_first_seen_ts': [
+        ([('hash', ASCENDING)], {'unique': True}),
+        # Mempool at the block: timestamp <= block ts and
+        # no block_number or block_number >= block
+        ([('block_number', ASCENDING), ('timestamp', ASCENDING)], {}),
+    ],
+    'tx_details': [
+        ([('hash', ASCENDING)], {'unique': True}),
+    ],
+    'tx_estimated_gas': [
+        ([('hash', ASCENDING)], {}),
+    ],
+    'addresses_info': [
+        ([('address', ASCENDING)], {'unique': True}),
+        ([('address', ASCENDING), ('history.block', ASCENDING)], {}),
+    ],
+}
+
+# stage_history is capped and optional, its index is created
+# by prepare_checkpoints
+ANALYTICS_INDEXES = {
+    'censored_txs': [
+        ([('hash', ASCENDING)], {'unique': True}),
+    ],
+    'validators': [
+        ([('pubkey', ASCENDING)], {'unique': True}),
+    ],
+    'validators_metrics': [
+        ([('name', ASCENDING)], {}),
+    ],
+    'ofac_addresses': [
+        ([('timestamp', DESCENDING)], {}),
+    ],
+    'block_numbers_slots': [
+        ([('block_number', DESCENDING)], {}),
+    ],
+}
+
+# API reads the analytics database
+API_INDEXES = {
+    'censored_txs': [
+        ([('non_ofac_compliant', ASCENDING), ('block_ts', ASCENDING)], {}),
+    ],
+    # Lido validators names
+    'validators': [
+        ([('pool_name', ASCENDING)], {}),
+    ],
+    # Metrics of the chosen validators
+    'validators_metrics': [
+        ([('name', ASCENDING)], {}),
+    ],
+}
+
+# Hot queries of each database, none of them may scan a whole collection:
+# (collection, filter, sort)
+COLLECTOR_QUERIES = [
+    ('tx_first_seen_ts', {'hash': {'$in': ['0x']}}, None),
+    ('tx_first_seen_ts',
+     {'timestamp': {'$lte': 0}, 'block_number': {'$exists': False}}, None),
+    ('tx_first_seen_ts',
+     {'timestamp': {'$lte': 0},
+      '$or': [{'block_number': {'$exists': False}},
+              {'block_number': {'$gte': 0}}]}, None),
+    ('tx_details', {'hash': {'$in': ['0x']}}, None),
+    ('tx_estimated_gas', {'hash': {'$in': ['0x']}}, None),
+    ('addresses_info', {'address': {'$in': ['0x']}}, None),
+]
+
+ANALYTICS_QUERIES = [
+    ('censored_txs', {'hash': {'$eq': '0x'}}, None),
+    ('validators', {'pubkey': {'$eq': '0x'}}, None),
+    ('validators_metrics', {'name': {'$eq': ''}}, None),
+    ('ofac_addresses', {'timestamp': {'$lte': 0}},
+     [('timestamp', DESCENDING)]),
+    ('block_numbers_slots', {'block_number': {'$eq': 0}}, None),
+    ('block_numbers_slots', {}, [('block_number', DESCENDING)]),
+]
+
+API_QUERIES = [
+    ('censored_txs',
+     {'block_ts': {'$gte': 0, '$lt': 0}, 'non_ofac_compliant': True}, None),
+    ('validators', {'pool_name': 'Lido'}, None),
+    ('validators_metrics', {'name': {'$in': ['']}}, None),
+    ('ofac_addresses', {'timestamp': {'$gte': 0, '$lt': 0}}, None),
+]
+
+
+def ensure_indexes(db: Database,
+                   indexes: Dict[str, List[Tuple[List, Dict[str, Any]]]]):
+    ''' Create indexes of the registry, existing ones are kept'''
+    for collection, collection_indexes in indexes.items():
+        for keys, options in collection_indexes:
+            db[collection].create_index(keys, **options)
+    logger.info((f'{db.name}: indexes of {len(indexes)} collections '
+                 'are ready'))
+
+
+def get_plan_stages(plan: Any) -> List[str]:
+    ''' All stage names of explain() query plan'''
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(get_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(get_plan_stages(value))
+    return stages
+
+
+def check_query_plans(db: Database, queries: List[Tuple]):
+    '''
+    Check that hot queries use indexes
+    Args:
+        db:         Database
+        queries:    List of (collection, filter, sort)
+    Raises:
+        Exception if any query plan has a collection scan
+    '''
+    collection_scans = []
+    for collection, query, sort in queries:
+        cursor = db[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in get_plan_stages(plan):
+            collection_scans.append(f'{collection}: {query} sort {sort}')
+    if collection_scans:
+        msg = (f'{db.name}: collection scan in query plans: '
+               + '; '.join(collection_scans))
+        logger.error(msg)
+        raise Exception(msg)
+    logger.info(f'{db.name}: {len(queries)} hot queries use indexes')
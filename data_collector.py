@@ -23,6 +23,10 @@ logger = logging.getLogger(__name__)
 def main():
     web3_url = os.environ.get('node_url', '')
     web3_connection_type = os.environ.get('node_connection_type', '')
+    # 'poll' or 'subscribe' (push based, needs ipc or ws connection)
+    mempool_ingestion_mode = os.environ.get('mempool_ingestion_mode', 'poll')
+    # Local Prometheus metrics endpoint, 0 - disabled
+    metrics_port = int(os.environ.get('collector_metrics_port', '9108'))
 
     db_col_url = os.environ.get('db_collector_url', 'localhost')
     db_col_port = os.environ.get('db_collector_port', '27017')
@@ -37,7 +41,8 @@ def main():
                 web3_type=web3_connection_type,
                 web3_url=web3_url,
                 interval=0.5,
-                verbose=False)
+                verbose=False,
+                ingestion_mode=mempool_ingestion_mode)
     block_collector = BlockCollector(
                 mongo_url=mongo_url,
                 db_name=db_col_name,
@@ -54,7 +59,8 @@ def main():
                 verbose=True)
     collectors = [mempool_collecotr, block_collector, mempool_gas_estimator]
 
-    data_collector = CollectorManager(collectors)
+    data_collector = CollectorManager(collectors,
+                                      metrics_port=metrics_port)
     asyncio.run(data_collector.start())
 
 
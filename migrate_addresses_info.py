@@ -0,0 +1,42 @@
+import logging
+import logging.config
+import os
+
+import yaml
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+from censorability_monitor.data_collection.accounts import (
+    AccountHistoryStore, migrate_legacy_accounts)
+from censorability_monitor.indexes import COLLECTOR_INDEXES, ensure_indexes
+
+load_dotenv()
+
+with open('logging.yaml', 'r') as f:
+    config = yaml.safe_load(f.read())
+    logging.config.dictConfig(config)
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    '''Migrate addresses_info documents from per-block keys
+       to the latest/history schema'''
+    db_col_url = os.environ.get('db_collector_url', 'localhost')
+    db_col_port = os.environ.get('db_collector_port', '27017')
+    db_col_usr = os.environ.get('db_collector_username', 'root')
+    db_col_pass = os.environ.get('db_collector_password', 'password')
+    db_col_name = os.environ.get('db_collector_name', 'ethereum_mempool')
+    mongo_url = f'mongodb://{db_col_usr}:{db_col_pass}@{db_col_url}:{db_col_port}/' # noqa E501
+
+    db = MongoClient(mongo_url)[db_col_name]
+    accounts_store = AccountHistoryStore(db['addresses_info'])
+    logger.info('Migrating addresses_info')
+    migrated = migrate_legacy_accounts(accounts_store.collection,
+                                       accounts_store.history_size)
+    ensure_indexes(db, {'addresses_info': COLLECTOR_INDEXES['addresses_info']})
+    logger.info(f'Migrated {migrated} accounts')
+
+
+if __name__ == '__main__':
+    main()